@@ -1,12 +1,15 @@
+import encodium
 from spore import Spore
-from cryptonet.seeknbuild import SeekNBuild
+from cryptonet.seeknbuild import SeekNBuild, HeaderChain
 from cryptonet.chain import Chain
 from cryptonet.utilities import global_hash
-from cryptonet.database import Database
-from cryptonet.errors import ValidationError
+from cryptonet.database import Database, PersistentDatabase
+from cryptonet.errors import ValidationError, TemporaryValidationError
 from cryptonet.datastructs import *
+from cryptonet.constants import MAX_BLOCKS_MESSAGE_BYTES
 from cryptonet.miner import Miner
 from cryptonet.debug import debug
+from cryptonet.verifier import default_verifier, DeferredChecks
 import cryptonet.standard
 
 config = {'network_debug': True}
@@ -23,18 +26,24 @@ class FakeSpore(object):
         pass
 
 class Cryptonet(object):
-    def __init__(self, seeds, address, block_class=cryptonet.standard.Block, mine=False, alert_pubkey_x=0, enable_p2p=True):
+    def __init__(self, seeds, address, block_class=cryptonet.standard.Block, mine=False, alert_pubkey_x=0, enable_p2p=True,
+                 db_path=None, mining_processes=1):
+        self._Block = block_class
         if enable_p2p:
             self.p2p = Spore(seeds=seeds, address=address)
             self.set_handlers()
         else:
             self.p2p = FakeSpore()
 
-        self.db = Database()
+        if db_path is None:
+            self.db = Database()
+        else:
+            self.db = PersistentDatabase(db_path, block_class)
         self.chain = Chain(db=self.db)
         self.seek_n_build = SeekNBuild(self.p2p, self.chain)
         self.mine = mine
-        self.miner = Miner(self.chain, self.seek_n_build)
+        self.miner = Miner(self.chain, self.seek_n_build, processes=mining_processes)
+        self.verifier = default_verifier
 
         self.mine_genesis = False
         if not hasattr(block_class, 'GENESIS') or block_class.GENESIS is None:
@@ -47,23 +56,95 @@ class Cryptonet(object):
         self.alert_pubkey_x = alert_pubkey_x
         self.alerts = {}
 
-        self._Block = block_class
         self.chain._Block = block_class
         if self.mine_genesis:
             self.genesis = self._Block.get_unmined_genesis()
             self.miner.mine(self.genesis)
 
         self.chain.set_genesis(self.genesis)
+        self.chain.load_chain()
 
     def run(self):
+        self.seek_n_build.run()
         if self.mine: self.miner.run()
         self.p2p.run()
         self.seek_n_build.shutdown()
         if self.mine: self.miner.shutdown()
+        self.verifier.shutdown()
+        if self.db.persistent:
+            self.chain.save_chain()
+        self.db.close()
 
     def shutdown(self):
         self.p2p.shutdown()
 
+    def compact_relay(self):
+        ''' Compact block relay is used when the block class can be rebuilt from its header and super_txs. '''
+        return hasattr(self._Block, 'from_compact')
+
+    def pending_super_txs(self):
+        ''' Looks up unconfirmed super_txs (those in the mempool) by short id, for rebuilding compact blocks. '''
+        state_maker = getattr(self.chain.head, 'state_maker', None)
+        if state_maker == None:
+            return lambda short_id: None
+        return state_maker.mempool.get_by_short_id
+
+    def accept_super_tx(self, super_tx):
+        ''' Add a relayed super_tx to the mempool and the future block, so compact blocks including it can be rebuilt
+        without asking for it. Returns True if it was new and applied, and so should be relayed on.
+        Called from P2P handlers and RPC; holds chain.lock while changing the future state, which chain_builder's
+        reorganisations rebuild.
+        '''
+        try:
+            super_tx.assert_internal_consistency()
+        except (ValidationError, encodium.ValidationError) as e:
+            debug('accept_super_tx error', e)
+            return False
+        with self.chain.lock:
+            state_maker = getattr(self.chain.head, 'state_maker', None)
+            if state_maker == None or super_tx.get_hash() in state_maker.mempool:
+                return False
+            if not state_maker.apply_super_tx_to_future(super_tx):
+                return False
+        self.chain.restart_miner()
+        return True
+
+    def accept_compact_block(self, node, compact, super_txs):
+        ''' Rebuild and accept a compact block. If it doesn't check out (e.g. a short id collision) the full block
+        is requested instead.
+        '''
+        try:
+            with DeferredChecks():
+                block = self._Block.from_compact(compact, super_txs)
+                block.assert_internal_consistency()
+        except (ValidationError, encodium.ValidationError) as e:
+            debug('accept_compact_block error', e)
+            self.seek_n_build.seek_hash_now(self._Block.HEADER_CLASS(compact.header).get_hash())
+            return
+        self.accept_blocks(node, [block], [None])
+
+    def accept_blocks(self, node, potential_blocks, digests):
+        ''' Check the signatures of internally consistent blocks from node all at once and pass the valid ones to
+        seek_n_build. digests are those of the blocks' bytes (see ReceivedBlocks), or None for rebuilt blocks.
+        '''
+        received = self.seek_n_build.received
+        signatures_valid = self.verifier.verify_blocks(potential_blocks)
+        for potential_block, digest, valid in zip(potential_blocks, digests, signatures_valid):
+            if not valid:
+                debug('accept_blocks: invalid signature in block %064x' % potential_block.get_hash())
+                if digest != None:
+                    received.add(digest, received.REJECTED)
+                continue
+            if digest != None:
+                received.add(digest, potential_block.get_hash())
+            debug('accept_blocks: accepting block of height %d' % potential_block.height)
+            self.seek_n_build.add_block(potential_block, node)
+            self.seek_n_build.seek_many_with_priority(potential_block.related_blocks())
+
+    def headers_first(self):
+        ''' Headers-first sync is used when the block class names its header class. '''
+        return hasattr(self._Block, 'HEADER_CLASS')
+
     # =================
     # Decorators
     #=================
@@ -71,12 +152,14 @@ class Cryptonet(object):
     def block(self, block_object):
         self._Block = block_object
         self.chain._Block = block_object
+        self.db._Block = block_object
         if self.mine_genesis:
             genesis_block = self._Block.get_unmined_genesis()
             self.miner.mine(genesis_block)
         else:
             genesis_block = self._Block().make(self.genesis_binary)
         self.chain.set_genesis(genesis_block)
+        self.chain.load_chain()
         return block_object
 
 
@@ -90,9 +173,15 @@ class Cryptonet(object):
         @self.p2p.on_connect
         def on_connect_handler(node):
             debug('on_connect_handler')
+            self.seek_n_build.add_peer(node)
             my_intro = Intro(top_block=self.chain.head.get_hash())
             node.send('intro', my_intro)
 
+        @self.p2p.on_disconnect
+        def on_disconnect_handler(node):
+            debug('on_disconnect_handler')
+            self.seek_n_build.remove_peer(node)
+
 
         @self.p2p.on_message('intro', Intro)
         def intro_handler(node, their_intro):
@@ -103,35 +192,154 @@ class Cryptonet(object):
             debug('intro_handler: the peer: ', node.address)
             if not self.chain.has_block_hash(their_intro.top_block):
                 debug('intro_handler: their top_block %064x' % their_intro.top_block)
-                self.seek_n_build.seek_hash_now(their_intro.top_block)
+                if self.headers_first():
+                    node.send('request_headers', self.seek_n_build.get_locator())
+                else:
+                    self.seek_n_build.seek_hash_now(their_intro.top_block)
+
+        @self.p2p.on_message('request_headers', RequestHeadersMessage)
+        def request_headers_handler(node, locator):
+            debug('MSG request_headers : %064x' % locator.get_hash())
+            if not self.headers_first():
+                return
+            start = self.chain.find_fork_height(locator) + 1
+            headers = HeadersMessage()
+            for block_hash in self.chain.get_main_chain_hashes(start, start + HeaderChain.MAX_HEADERS):
+                headers.append(self.chain.get_block(block_hash).header.serialize())
+            if headers.len() > 0:
+                node.send('headers', headers)
+
+        @self.p2p.on_message('headers', HeadersMessage)
+        def headers_handler(node, serialized_headers):
+            debug('MSG headers : %064x' % serialized_headers.get_hash())
+            if not self.headers_first():
+                return
+            headers = []
+            for serialized_header in serialized_headers:
+                try:
+                    headers.append(self._Block.HEADER_CLASS(serialized_header))
+                except (ValidationError, encodium.ValidationError) as e:
+                    debug('headers_handler error', e)
+                    break
+            self.seek_n_build.add_headers(node, headers)
 
 
         @self.p2p.on_message('blocks', BytesList)
         def blocks_handler(node, block_list):
             if config['network_debug'] or True:
                 debug('MSG blocks : %064x' % block_list.get_hash())
+            received = self.seek_n_build.received
+            potential_blocks = []
+            digests = []
             for serialized_block in block_list:
+                # blocks we've seen before are dropped by a digest of their bytes, without decoding them
+                digest = received.digest(serialized_block)
+                if digest in received:
+                    block_hash = received.get(digest)
+                    if block_hash == received.REJECTED or self.seek_n_build.is_known(block_hash):
+                        continue
                 try:
-                    potential_block = self._Block(serialized_block)
-                    potential_block.assert_internal_consistency()
-                    debug('blocks_handler: accepting block of height %d' % potential_block.height)
-                except ValidationError as e:
+                    # signatures are checked below for all blocks at once
+                    with DeferredChecks():
+                        potential_block = self._Block(serialized_block)
+                        if self.seek_n_build.is_known(potential_block.get_hash()):
+                            received.add(digest, potential_block.get_hash())
+                            continue
+                        # checks the header's PoW before the body
+                        potential_block.assert_internal_consistency()
+                except (ValidationError, encodium.ValidationError) as e:
                     debug('blocks_handler: serialized_block:', serialized_block)
                     debug('blocks_handler error', e)
+                    if not isinstance(e, TemporaryValidationError):
+                        received.add(digest, received.REJECTED)
                     #node.misbehaving()
                     continue
-                self.seek_n_build.add_block(potential_block)
-                self.seek_n_build.seek_many_with_priority(potential_block.related_blocks())
+                potential_blocks.append(potential_block)
+                digests.append(digest)
+            self.accept_blocks(node, potential_blocks, digests)
+
+
+        @self.p2p.on_message('compact_block', CompactBlock)
+        def compact_block_handler(node, compact):
+            if config['network_debug'] or True:
+                debug('MSG compact_block : %064x' % compact.get_hash())
+            if not self.compact_relay():
+                return
+            try:
+                header = self._Block.HEADER_CLASS(compact.header)
+                if self.seek_n_build.is_known(header.get_hash()):
+                    return
+                header.assert_internal_consistency()
+            except (ValidationError, encodium.ValidationError) as e:
+                debug('compact_block_handler error', e)
+                return
+            super_txs, missing = self.seek_n_build.compact_blocks.start(header.get_hash(), compact,
+                                                                         self.pending_super_txs())
+            if len(missing) > 0:
+                debug('compact_block_handler: requesting %d of %d super_txs' % (len(missing), len(super_txs)))
+                node.send('request_super_txs', RequestSuperTxs(block_hash=header.get_hash(), indexes=missing))
+                self.seek_n_build.watch_compact_blocks()
+                return
+            self.accept_compact_block(node, compact, super_txs)
+
+
+        @self.p2p.on_message('request_super_txs', RequestSuperTxs)
+        def request_super_txs_handler(node, request):
+            # a request we can't answer gets an empty reply, so the requester asks for the full block straight away
+            reply = BlockSuperTxs(block_hash=request.block_hash)
+            if self.chain.has_block_hash(request.block_hash):
+                block_super_txs = self.chain.get_block(request.block_hash).super_txs
+                if all(index < len(block_super_txs) for index in request.indexes):
+                    for index in request.indexes:
+                        reply.super_txs.append(block_super_txs[index].serialize())
+            node.send('block_super_txs', reply)
+
+
+        @self.p2p.on_message('block_super_txs', BlockSuperTxs)
+        def block_super_txs_handler(node, reply):
+            if not self.compact_relay():
+                return
+            try:
+                # signatures are checked with the rest of the block in accept_blocks
+                with DeferredChecks():
+                    super_txs = [self._Block.SUPER_TX_CLASS(serialized) for serialized in reply.super_txs]
+            except (ValidationError, encodium.ValidationError) as e:
+                debug('block_super_txs_handler error', e)
+                super_txs = None
+            filled = None
+            if super_txs != None:
+                filled = self.seek_n_build.compact_blocks.fill(reply.block_hash, super_txs)
+            if filled == None:
+                self.seek_n_build.seek_hash_now(reply.block_hash)
+                return
+            self.accept_compact_block(node, *filled)
+
+
+        if hasattr(self._Block, 'SUPER_TX_CLASS'):
+            @self.p2p.on_message('super_tx', self._Block.SUPER_TX_CLASS)
+            def super_tx_handler(node, super_tx):
+                debug('MSG super_tx : %064x' % super_tx.get_hash())
+                if self.accept_super_tx(super_tx):
+                    self.p2p.broadcast('super_tx', super_tx)
 
 
         @self.p2p.on_message('request_blocks', HashList)
         def request_blocks_handler(node, requests):
             if config['network_debug'] or True:
                 debug('MSG request_blocks : %064x' % requests.get_hash())
+            # blocks are sent as stored, in messages of at most about MAX_BLOCKS_MESSAGE_BYTES
             blocks_to_send = BytesList()
+            size = 0
             for bh in requests:
-                if self.chain.has_block_hash(bh):
-                    blocks_to_send.append(self.chain.get_block(bh).serialize())
+                if not self.chain.has_block_hash(bh):
+                    continue
+                serialized_block = self.chain.get_serialized_block(bh)
+                if blocks_to_send.len() > 0 and size + len(serialized_block) > MAX_BLOCKS_MESSAGE_BYTES:
+                    node.send('blocks', blocks_to_send)
+                    blocks_to_send = BytesList()
+                    size = 0
+                blocks_to_send.append(serialized_block)
+                size += len(serialized_block)
             if blocks_to_send.len() > 0:
                 node.send('blocks', blocks_to_send)
 
@@ -1,24 +1,90 @@
-from queue import Queue, PriorityQueue
+import threading
+
 import cryptonet
 from cryptonet.debug import debug
 from cryptonet.errors import ChainError
+from cryptonet.constants import CHAINSTATE_KEY
+from cryptonet.datastructs import ChainState
 import cryptonet.standard
 
 
-class PriorityQueueWithInvalidChecks(PriorityQueue):
-
-    def __init__(self, max_size=0):
-        self.invalid_set = set()
-        PriorityQueue.__init__(self, max_size)
-
-    def get(self, block=True, timeout=None):
-        potential_get = PriorityQueue.get(self, block, timeout)
-        if potential_get in self.invalid_set:
-            return self.get(block, timeout)
-        return potential_get
+class TipSet(object):
+    ''' The chain's tips (known valid blocks with no known valid children) keyed by exact integer priority.
+    An indexed binary heap: add and remove are O(log n) and best is O(1). Entries are removed eagerly, so memory is
+    proportional to the number of live tips rather than every block ever seen.
+    '''
 
-    def add_to_invalid_set(self, to_make_invalid):
-        self.invalid_set.add(to_make_invalid)
+    def __init__(self):
+        self.heap = []  # (-priority, block_hash); the best tip is at self.heap[0]
+        self.positions = {}  # block_hash -> index in self.heap
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.positions
+
+    def add(self, block_hash, priority):
+        with self.lock:
+            self.remove(block_hash)
+            self.heap.append((-priority, block_hash))
+            self.positions[block_hash] = len(self.heap) - 1
+            self._sift_up(len(self.heap) - 1)
+
+    def remove(self, block_hash):
+        ''' Returns True if block_hash was a tip. '''
+        with self.lock:
+            index = self.positions.pop(block_hash, None)
+            if index == None:
+                return False
+            last = self.heap.pop()
+            if index < len(self.heap):
+                self._place(last, index)
+                self._sift_up(self._sift_down(index))
+            return True
+
+    def best(self):
+        ''' Returns the hash of the tip with the highest priority, or None. '''
+        with self.lock:
+            if len(self.heap) == 0:
+                return None
+            return self.heap[0][1]
+
+    def items(self):
+        ''' Returns a list of (block_hash, priority). '''
+        with self.lock:
+            return [(block_hash, -negative_priority) for negative_priority, block_hash in self.heap]
+
+    def _place(self, entry, index):
+        self.heap[index] = entry
+        self.positions[entry[1]] = index
+
+    def _sift_up(self, index):
+        entry = self.heap[index]
+        while index > 0:
+            parent = (index - 1) // 2
+            if not entry < self.heap[parent]:
+                break
+            self._place(self.heap[parent], index)
+            index = parent
+        self._place(entry, index)
+        return index
+
+    def _sift_down(self, index):
+        entry = self.heap[index]
+        while True:
+            child = 2 * index + 1
+            if child >= len(self.heap):
+                break
+            if child + 1 < len(self.heap) and self.heap[child + 1] < self.heap[child]:
+                child += 1
+            if not self.heap[child] < entry:
+                break
+            self._place(self.heap[child], index)
+            index = child
+        self._place(entry, index)
+        return index
 
 
 class Chain(object):
@@ -31,7 +97,7 @@ class Chain(object):
 
     The chain has a head, which is considered to be the most up to date snapshot of the network.
     Each block has a parent_hash variable which points to the (most dominant) parent. Dominant meaning largest priority.
-    The chain requires block.priority to be set to something orderable.
+    The chain requires block.priority to be set to something orderable, ideally an exact integer such as total work.
     block.on_genesis(chain) is called when a block is set to the genesis block.
     block.assert_internal_consistency() and block.assert_validity(chain) must be defined; they will be called and should
      raise a ValidationError to fail.
@@ -42,6 +108,13 @@ class Chain(object):
 
     This structure can theoretically support more general structures than just a chain: blocktrees and blockgraphs are
     possible too.
+
+    Threads: once the node is running only SeekNBuild's chain_builder (on SeekNBuild's loop) adds blocks;
+    set_genesis(), load_chain() and save_chain() are called before it starts or after it stops. The miner only reads.
+    P2P handlers and RPC otherwise only read too, except that new super_txs are applied to the head's future state
+    (Cryptonet.accept_super_tx), which a reorganisation rebuilds. add_block() holds self.lock throughout, so readers
+    and that writer, which take it, never see a half finished reorganisation; single lookups (has_block_hash, head)
+    don't need it.
     '''
 
     def __init__(self, genesis_block=None, db=None, block_class=cryptonet.standard.Block):
@@ -55,10 +128,14 @@ class Chain(object):
         self.head = None
         self.db = db
         self.miner = None
-        self.blocks = set()
         self.block_hashes = set()
         self.invalid_block_hashes = set()
-        self.block_hashes_with_priority = PriorityQueueWithInvalidChecks()  # inverse_priority, block_hash
+        self.tips = TipSet()
+        self.lock = threading.RLock()
+
+        # with a persistent db the chainstate is saved every save_interval new heads (and on shutdown)
+        self.save_interval = 100
+        self._heads_since_save = 0
 
         self.genesis_block = None
         if genesis_block != None:
@@ -74,8 +151,12 @@ class Chain(object):
             return None
         return self.db.get_entry(block_hash)
 
+    def get_serialized_block(self, block_hash):
+        ''' The block's serialized bytes, without re-encoding it where the db already has them. '''
+        return self.db.get_raw_entry(block_hash)
+
     def has_block(self, block):
-        return block in self.blocks
+        return block.get_hash() in self.block_hashes
 
     def has_block_hash(self, block_hash):
         return block_hash in self.block_hashes
@@ -117,16 +198,75 @@ class Chain(object):
             # send blocks: from, around, to
             success = self.head.reorganisation(self, self.head, lca_of_head_and_new_head, new_head)
         else:
+            lca_of_head_and_new_head = None
             success = new_head.reorganisation(self, new_head, new_head, new_head)
         if success:
+            self._update_main_chain(lca_of_head_and_new_head, new_head)
             self.head = new_head
             debug('chain: new head %d, hash: %064x' % (new_head.height, new_head.get_hash()))
+            self.restart_miner()
+            self._heads_since_save += 1
+            if self.db.persistent and self._heads_since_save >= self.save_interval:
+                self.save_chain()
         else:
             debug('chain: set_head failed: #%d, H: %064x' % (new_head.height, new_head.get_hash()))
 
+    def _update_main_chain(self, lca, new_head):
+        ''' Replace the db's main chain index above lca with the path to new_head in a single update. '''
+        if lca == None:
+            # e.g. the genesis block on restart, when the saved index must be kept for load_chain()
+            if self.db.get_main_chain_hash(new_head.height) != new_head.get_hash():
+                self.db.set_main_chain(new_head.height, [new_head.get_hash()])
+            return
+        path = self.construct_chain_path(lca.get_hash(), new_head.get_hash())
+        self.db.set_main_chain(lca.height + 1, [block.get_hash() for block in path])
+
+    def _reconcile_main_chain(self, head):
+        ''' Make the main chain index end at head, e.g. after load_chain() restores an older head.
+        Follows the db's parent links, so no blocks are decoded.
+        '''
+        path = []
+        block_hash, height = head.get_hash(), head.height
+        while self.db.get_main_chain_hash(height) != block_hash:
+            path.append(block_hash)
+            links = self.db.get_ancestor_links(block_hash)
+            if len(links) == 0:
+                break
+            block_hash = links[0]
+            height = self.db.get_height(block_hash)
+        if len(path) > 0 or self.db.get_main_chain_hash(head.height + 1) != None:
+            self.db.set_main_chain(head.height - len(path) + 1, path[::-1])
+
+    def get_block_at_height(self, height):
+        ''' Returns the main chain's block at height, or None. '''
+        with self.lock:
+            block_hash = self.db.get_main_chain_hash(height)
+        if block_hash == None:
+            return None
+        return self.get_block(block_hash)
+
+    def get_main_chain_hashes(self, start, end):
+        ''' Returns the hashes of the main chain's blocks with start <= height < end. '''
+        with self.lock:
+            return self.db.get_main_chain_hashes(start, end)
+
+    def find_fork_height(self, locator):
+        ''' Returns the height of the first hash in locator that is on the main chain, or 0 (genesis) if none are.
+        '''
+        with self.lock:
+            for block_hash in locator:
+                height = self.db.get_height(block_hash)
+                if height != None and self.db.get_main_chain_hash(height) == block_hash:
+                    return height
+            return 0
+
     def add_block(self, block):
         ''' returns True on success
         '''
+        with self.lock:
+            return self._add_block(block)
+
+    def _add_block(self, block):
         if self.has_block(block):
             return
         if block.get_hash() in self.invalid_block_hashes or block.parent_hash in self.invalid_block_hashes:
@@ -134,24 +274,76 @@ class Chain(object):
             self.invalid_block_hashes.add(block.get_hash())
             return
 
-        self.db.set_entry(block.get_hash(), block)
-        self.db.set_ancestors(block)
-        self.blocks.add(block)
+        if not self.db.key_exists(block.get_hash()):
+            # a persistent db may already hold this block from a previous run
+            self.db.set_entry(block.get_hash(), block)
+            self.db.set_ancestors(block)
         self.block_hashes.add(block.get_hash())
-        self.block_hashes_with_priority.put((1 / (1 + block.priority), block.get_hash()))
+        self.tips.remove(block.parent_hash)
+        self.tips.add(block.get_hash(), block.priority)
 
         if block.better_than(self.head):
             self.set_head(block)
 
         debug('added block %d, hash: %064x' % (block.priority, block.get_hash()))
 
-        self.restart_miner()
-
         return True
 
+    def save_chain(self):
+        ''' Write the chainstate (head, known and invalid block hashes, tips with priorities, and a snapshot of the
+        head's dapp states) to the db so load_chain() can resume from head after a restart.
+        '''
+        with self.lock:
+            self._save_chain()
+
+    def _save_chain(self):
+        if not self.initialized:
+            return
+        tips = self.tips.items()
+        if getattr(self.head, 'state_maker', None) != None:
+            dapp_states = self.head.state_maker.snapshot()
+        else:
+            dapp_states = []
+        chain_state = ChainState(
+            head=self.head.get_hash(),
+            block_hashes=list(self.block_hashes),
+            tips=[block_hash for block_hash, _ in tips],
+            tip_priorities=[priority for _, priority in tips],
+            invalid_block_hashes=list(self.invalid_block_hashes),
+            dapp_states=dapp_states,
+        )
+        self.db.set_metadata(CHAINSTATE_KEY, chain_state.serialize())
+        self._heads_since_save = 0
+        debug('chain: saved chainstate at %d, hash: %064x' % (self.head.height, self.head.get_hash()))
+
     def load_chain(self):
-        # TODO : load chainstate from database
-        pass
+        ''' Restore the chainstate written by save_chain(), if there is one.
+        Must be called after set_genesis(). The head's state is restored from the snapshot, so no blocks are
+        re-applied; the cost is proportional to the size of the chainstate rather than the height of the chain.
+        Returns True if a chainstate was loaded.
+        '''
+        if self.db == None or self.db.get_metadata(CHAINSTATE_KEY) == None:
+            return False
+        self._assert_true(self.initialized, 'load_chain requires the genesis block to be set')
+        chain_state = ChainState(self.db.get_metadata(CHAINSTATE_KEY))
+        head = self.get_block(chain_state.head)
+
+        self.block_hashes = set(chain_state.block_hashes)
+        self.invalid_block_hashes = set(chain_state.invalid_block_hashes)
+        self.tips = TipSet()
+        for block_hash, priority in zip(chain_state.tips, chain_state.tip_priorities):
+            self.tips.add(block_hash, priority)
+
+        state_maker = getattr(self.genesis_block, 'state_maker', None)
+        if state_maker != None:
+            state_maker.restore(chain_state.dapp_states, head)
+            head._set_state_maker(state_maker)
+        self._reconcile_main_chain(head)
+        self.head = head
+        self._heads_since_save = 0
+        debug('chain: loaded chainstate, head %d, hash: %064x' % (head.height, head.get_hash()))
+        self.restart_miner()
+        return True
 
     def learn_of_db(self, db):
         self.db = db
@@ -160,39 +352,51 @@ class Chain(object):
     def find_lca(self, block_hash_a, block_hash_b):
         '''
         This finds the LCA of two blocks given their hashes.
-        Currently walks through each blocks parents in turn until a match is found and returns that match.
+        Uses the heights and power-of-two ancestor links kept by the db (see Database.set_ancestors): both blocks are
+        brought to the same height, then jump together by the largest power of two that keeps them apart. This takes
+        O(log n) lookups instead of fetching every block back to the fork.
         '''
-        mutual_history = set()
-        blocks = [self.get_block(block_hash_a), self.get_block(block_hash_b)]
-        while True:
-            if blocks[0].get_hash() == blocks[1].get_hash():
-                return blocks[0]
-            if blocks[0].parent_hash == 0 and blocks[1].parent_hash == 0:
+        height_a = self.db.get_height(block_hash_a)
+        height_b = self.db.get_height(block_hash_b)
+        if height_a == None or height_b == None:
+            raise ChainError('No LCA - unknown block.')
+        height = min(height_a, height_b)
+        hash_a = self.db.get_ancestor(block_hash_a, height_a - height)
+        hash_b = self.db.get_ancestor(block_hash_b, height_b - height)
+        if hash_a == None or hash_b == None:
+            raise ChainError('No LCA - missing ancestor links.')
+        if hash_a != hash_b:
+            for power in reversed(range(height.bit_length())):
+                step = 2 ** power
+                if step > height:
+                    continue
+                ancestor_a = self.db.get_ancestor(hash_a, step)
+                ancestor_b = self.db.get_ancestor(hash_b, step)
+                if ancestor_a != ancestor_b:
+                    hash_a, hash_b, height = ancestor_a, ancestor_b, height - step
+            hash_a = self.db.get_ancestor(hash_a, 1)
+            hash_b = self.db.get_ancestor(hash_b, 1)
+            if hash_a == None or hash_a != hash_b:
                 raise ChainError('No LCA - different chains.')
-            for i in range(len(blocks)):
-                block_hash = blocks[i].get_hash()
-                if block_hash in mutual_history:
-                    # then this block is LCA
-                    return blocks[i]
-                mutual_history.add(block_hash)
-                if blocks[i].parent_hash != 0:
-                    blocks[i] = self.get_block(blocks[i].parent_hash)
+        return self.get_block(hash_a)
 
     def construct_chain_path(self, start_block_hash, end_block_hash):
         ''' Returns a list of Blocks, in the range (start_block_hash, end_block_hash]
+        The ancestry is checked with the skip links before any blocks on the path are fetched.
         '''
-        reversed_path = []
-        current_block_hash = end_block_hash
-        while current_block_hash != start_block_hash:
-            current_block = self.get_block(current_block_hash)
-            reversed_path.append(current_block)
-            current_block_hash = current_block.parent_hash
-            if current_block_hash == 0:
-                raise ChainError(
-                    'No path possible. %064x is not an ancestor of %064x' % (start_block_hash, end_block_hash))
+        if start_block_hash == end_block_hash:
+            return []
+        end_block = self.get_block(end_block_hash)
+        start_height = self.db.get_height(start_block_hash)
+        distance = end_block.height - start_height if start_height != None else 0
+        if distance <= 0 or self.db.get_ancestor(end_block_hash, distance) != start_block_hash:
+            raise ChainError(
+                'No path possible. %064x is not an ancestor of %064x' % (start_block_hash, end_block_hash))
+        reversed_path = [end_block]
+        while len(reversed_path) < distance:
+            reversed_path.append(self.get_block(reversed_path[-1].parent_hash))
         return reversed_path[::-1]
 
-
     def apply_chain_path(self, path_to_apply):
         ''' path_to_apply is a list of blocks to apply sequentially.
         '''
@@ -213,36 +417,46 @@ class Chain(object):
         ''' Find best block not in invalid_block_hashes.
         Run a reorg from head to that block.
         '''
-        block_hash = None
-        inverse_priority, block_hash = self.block_hashes_with_priority.get()
-        self.block_hashes_with_priority.put((inverse_priority, block_hash))
-        debug('_construct_best_chain: priority, best_block: %d, %064x' % (1 / inverse_priority - 1, block_hash))
+        block_hash = self.tips.best()
+        debug('_construct_best_chain: best_block: %064x' % block_hash)
         self.set_head(self.get_block(block_hash))
 
-    def _mark_invalid(self, invalid_block_hash):
-        debug('Chain: Marking %064x as invalid' % invalid_block_hash)
-        self.invalid_block_hashes.add(invalid_block_hash)
-        if invalid_block_hash in self.block_hashes:
-            invalid_block = self.get_block(invalid_block_hash)
-            self.block_hashes.remove(invalid_block_hash)
-            self.blocks.remove(invalid_block)
-            self.block_hashes_with_priority.add_to_invalid_set((invalid_block.priority, invalid_block_hash))
-
-    def _recursively_mark_invalid(self, invalid_block_hash):
-        children = self.get_children(invalid_block_hash)
-        if children != None:
-            for child in children[::-1]:
-                self._recursively_mark_invalid(child)
-        self._mark_invalid(invalid_block_hash)
+    def _mark_invalid(self, invalid_block_hashes):
+        ''' Mark a batch of block hashes as invalid and evict those that are known.
+        Returns the number of blocks evicted.
+        '''
+        debug('Chain: Marking %d blocks as invalid' % len(invalid_block_hashes))
+        self.invalid_block_hashes.update(invalid_block_hashes)
+        evicted = self.block_hashes.intersection(invalid_block_hashes)
+        if len(evicted) > 0:
+            self.block_hashes.difference_update(evicted)
+            for block_hash in evicted:
+                self.tips.remove(block_hash)
+        return len(evicted)
+
+    def _collect_subtree(self, block_hash):
+        ''' Returns block_hash and all of its descendants, breadth first, from the db's child index. '''
+        subtree = [block_hash]
+        i = 0
+        while i < len(subtree):
+            children = self.get_children(subtree[i])
+            if children != None:
+                subtree.extend(children)
+            i += 1
+        return subtree
 
     def recursively_mark_invalid(self, invalid_block_hash):
-        ''' Mark invalid_block as invalid within the chain and recursively mark all children invalid.
-        Wraps _recursively_mark_invalid() ~~so _check_head_not_invalid() is only called once.~~
-        Now just calls _recursivley_mark_invalid()
+        ''' Mark invalid_block as invalid within the chain, along with all of its descendants.
+        Iterative, so long invalid side chains can't hit the recursion limit.
+        Returns the number of blocks evicted.
         '''
-        self._recursively_mark_invalid(invalid_block_hash)
-        # self._make_head_not_invalid()
-        #self._construct_best_chain()
+        evicted = self._mark_invalid(self._collect_subtree(invalid_block_hash))
+        parent_hash = self.db.get_ancestor(invalid_block_hash, 1)
+        if parent_hash in self.block_hashes and not any(child in self.block_hashes for child in
+                                                        self.get_children(parent_hash)):
+            # the parent is a tip again
+            self.tips.add(parent_hash, self.get_block(parent_hash).priority)
+        return evicted
 
     def get_children(self, invalid_block_hash):
         ''' Find any children of block with hash invalid_block_hash.
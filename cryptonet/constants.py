@@ -3,4 +3,10 @@ SOFTWARE_VERSION = 'Cryptonet/Eudemonia/0.0.1'
 
 # Cryptonet Internal
 ROOT_DAPP = b''
-TX_TRACKER = b'_TX_TRACKER'
\ No newline at end of file
+TX_TRACKER = b'_TX_TRACKER'
+
+# Network
+MAX_BLOCKS_MESSAGE_BYTES = 2 ** 20  # replies to request_blocks are split into blocks messages of about this size
+
+# Database
+CHAINSTATE_KEY = b'chainstate'  # in the db's metadata
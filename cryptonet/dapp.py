@@ -1,7 +1,8 @@
-from encodium import Encodium, ValidationError
+import threading
 
-from cryptonet.utilities import global_hash
-from cryptonet.datastructs import MerkleLeavesToRoot
+from encodium import ValidationError
+
+from cryptonet.datastructs import MerklePatriciaTree, StateDeltaSnapshot, DappStateSnapshot
 from cryptonet.debug import debug
 
 ''' dapp.py
@@ -88,6 +89,86 @@ class Dapp(object):
     def get_height(self):
         return self.state.height
 
+    def snapshot(self):
+        ''' Return self.state and all its ancestors as a DappStateSnapshot. '''
+        return DappStateSnapshot(name=self.name, deltas=[d.to_snapshot() for d in self.state.ancestors()[::-1]])
+
+    def restore(self, snapshot):
+        ''' Replace self.state with the StateDeltas in snapshot. Alt states are forgotten. '''
+        self.state_bank = {}
+        self._set_state(StateDelta.from_snapshots(snapshot.deltas))
+
+
+class _KeyOwnerIndex(object):
+    ''' Maps each key to the StateDelta that holds its current value (or its deletion) as seen from self.owner.
+    One index is shared by every StateDelta descended from the same root. Before a different StateDelta writes, the
+    index is moved to it by undoing the deltas between the old owner and the common ancestor and redoing those down
+    to the new one, which costs O(keys touched). Reads only move it to descendants of the owner (see extends());
+    other states (e.g. the main state while the future state is being built) walk up their parents instead, so
+    reads alternating between states don't move the index back and forth.
+    '''
+
+    def __init__(self, owner):
+        self.owners = {}
+        self.owner = owner
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _touched_keys(state):
+        return set(state.key_value_store.keys()) | state.deleted_keys
+
+    @staticmethod
+    def _resolve(state, key):
+        ''' Walk up from state to find the owner of key, or None. '''
+        while state != None:
+            if key in state.key_value_store or key in state.deleted_keys:
+                return state
+            state = state.parent
+        return None
+
+    def move_to(self, state):
+        if self.owner is state:
+            return
+        undo, redo = [], []
+        old, new = self.owner, state
+        while old is not new:
+            if old.height >= new.height:
+                undo.append(old)
+                old = old.parent
+            else:
+                redo.append(new)
+                new = new.parent
+        common_ancestor = old
+        undone_keys = set()
+        for undo_state in undo:
+            undone_keys |= self._touched_keys(undo_state)
+        redone_keys = set()
+        for redo_state in reversed(redo):
+            for key in self._touched_keys(redo_state):
+                self.owners[key] = redo_state
+                redone_keys.add(key)
+        for key in undone_keys - redone_keys:
+            owner = self._resolve(common_ancestor, key)
+            if owner == None:
+                del self.owners[key]
+            else:
+                self.owners[key] = owner
+        self.owner = state
+
+    def extends(self, state):
+        ''' True if state is self.owner or one of its descendants. '''
+        current = state
+        while current != None and current.height > self.owner.height:
+            current = current.parent
+        return current is self.owner
+
+    def views(self, state):
+        ''' True if state is self.owner or one of its ancestors. '''
+        current = self.owner
+        while current != None and current.height > state.height:
+            current = current.parent
+        return current is state
+
 
 class StateDelta(object):
 
@@ -99,17 +180,23 @@ class StateDelta(object):
         self.parent = parent
         self.height = height
         self.child = None
-        self.my_hash = None
         self.deleted_keys = set()
+        # authenticated copy of the complete state at this delta, shares nodes with parent.tree
+        self.tree = parent.tree if parent != None else MerklePatriciaTree()
+        # key -> owning StateDelta, shared with all relatives; reads are a single dict probe
+        self.index = parent.index if parent != None else _KeyOwnerIndex(self)
+
+    def _owner_of(self, key):
+        with self.index.lock:
+            if self.index.extends(self):
+                self.index.move_to(self)
+                return self.index.owners.get(key)
+            return _KeyOwnerIndex._resolve(self, key)
 
     def __contains__(self, key):
-        if key in self.deleted_keys:
-            return False
-        if key in self.key_value_store:
-            return True
-        if self.parent == None:
-            return False
-        return key in self.parent
+        key = self._make_key_valid(key)
+        owner = self._owner_of(key)
+        return owner != None and key in owner.key_value_store
 
     def _make_key_valid(self, key):
         if not isinstance(key, int):
@@ -119,28 +206,32 @@ class StateDelta(object):
         return key
 
     def __getitem__(self, key):
-        ''' return value if known else ask next StateDelta '''
+        ''' return value if known (in this StateDelta or an ancestor) else 0 '''
         key = self._make_key_valid(key)
-        if key in self.deleted_keys:
-            pass
-        elif key in self.key_value_store:
-            return self.key_value_store[key]
-        elif self.parent != None:
-            return self.parent[key]
-        return 0
-
+        owner = self._owner_of(key)
+        if owner == None:
+            return 0
+        return owner.key_value_store.get(key, 0)
 
     def __setitem__(self, key, value):
         key = self._make_key_valid(key)
-        if key in self.deleted_keys:
-            self.deleted_keys.remove(key)
-        self.my_hash = None
-        self.key_value_store[key] = value
+        with self.index.lock:
+            self.index.move_to(self)
+            if key in self.deleted_keys:
+                self.deleted_keys.remove(key)
+            self.key_value_store[key] = value
+            self.index.owners[key] = self
+        self.tree = self.tree.set(key, value)
 
     def __delitem__(self, key):
-        self.deleted_keys.add(key)
-        if key in self.key_value_store:
-            del self.key_value_store[key]
+        key = self._make_key_valid(key)
+        with self.index.lock:
+            self.index.move_to(self)
+            self.deleted_keys.add(key)
+            if key in self.key_value_store:
+                del self.key_value_store[key]
+            self.index.owners[key] = self
+        self.tree = self.tree.delete(key)
 
     def recursively_print_state(self):
         debug('StateDelta: %05d, %s', (self.height, self.key_value_store))
@@ -150,10 +241,9 @@ class StateDelta(object):
     def all_keys(self):
         ''' Get keys from this k_v_store and parents, parents parents, etc.
         Returns a set. '''
-        keys = set(self.key_value_store.keys())
-        if self.parent != None:
-            keys = keys.union(self.parent.all_keys())
-        return keys - self.deleted_keys
+        with self.index.lock:
+            self.index.move_to(self)
+            return set(k for k, owner in self.index.owners.items() if k in owner.key_value_store)
 
     def complete_kvs(self):
         ''' Return flattened state as dict/k_v_store.
@@ -165,23 +255,8 @@ class StateDelta(object):
         return return_key_value_store
 
     def get_hash(self):
-        if self.my_hash == None:
-            #debug('StateDelta.get_hash, complete_kvs', self.complete_kvs())
-            keys = list(self.all_keys())
-            debug('StateDelta: get_hash: keys', keys)
-            # TODO: keys.sort() definition unknown ATM, needs to be specific so
-            # identical states generate identical hashes (ints and bytes may be
-            # being used as keys, not checked currently).
-            keys.sort()
-            leaves = []
-            for k in keys:
-                if isinstance(self[k], Encodium):
-                    leaves.extend([global_hash(k), self[k].get_hash()])
-                else:
-                    leaves.extend([global_hash(k), global_hash(self[k])])
-            merkle_tree = MerkleLeavesToRoot(leaves=leaves)
-            self.my_hash = merkle_tree.get_hash()
-        return self.my_hash
+        ''' Root of self.tree; only the nodes written since the last call are hashed. '''
+        return self.tree.get_hash()
 
     def ancestors(self):
         if self.parent == None:
@@ -237,10 +312,14 @@ class StateDelta(object):
         so return. If not, do what self.parent says.
         '''
         assert height >= 0
-        if self.height <= height:
-            self.child = None
-            return self
-        return self.parent.prune_to_or_beyond(height)
+        state = self
+        while state.height > height:
+            state = state.parent
+        state.child = None
+        # drop the pruned deltas from the index now rather than on the next read
+        with state.index.lock:
+            state.index.move_to(state)
+        return state
 
     def merge_with_child(self):
         ''' Triggers self.child.absorb(self); links self.child and self.parent. '''
@@ -252,11 +331,42 @@ class StateDelta(object):
 
     def absorb(self, parent_state):
         ''' Takes a state and underlay any entries in self.key_value_store '''
-        parent_keys = parent_state.key_value_store.keys()
-        for k in parent_keys:
-            if k in self.key_value_store:
-                continue
-            self.key_value_store[k] = parent_state.key_value_store[k]
+        with self.index.lock:
+            # keys parent_state owns in the index now belong to self, unless the index is looking at another branch
+            update_index = self.index.views(self)
+            for k in parent_state.key_value_store.keys():
+                if k not in self.key_value_store and k not in self.deleted_keys:
+                    self.key_value_store[k] = parent_state.key_value_store[k]
+            for k in parent_state.deleted_keys:
+                if k not in self.key_value_store:
+                    self.deleted_keys.add(k)
+            if update_index:
+                for k in _KeyOwnerIndex._touched_keys(parent_state):
+                    if self.index.owners.get(k) is parent_state:
+                        self.index.owners[k] = self
+
+    def to_snapshot(self):
+        ''' Return this StateDelta (not its ancestors) as a StateDeltaSnapshot. '''
+        keys = list(self.key_value_store.keys())
+        return StateDeltaSnapshot(height=self.height,
+                                  keys=keys,
+                                  values=[self.key_value_store[k] for k in keys],
+                                  deleted_keys=[self._make_key_valid(k) for k in self.deleted_keys])
+
+    @staticmethod
+    def from_snapshots(snapshots):
+        ''' Rebuild a chain of StateDeltas from snapshots (oldest first) and return the youngest. '''
+        state = None
+        for snapshot in snapshots:
+            new_state = StateDelta(state, snapshot.height)
+            for key in snapshot.deleted_keys:
+                del new_state[key]
+            for key, value in zip(snapshot.keys, snapshot.values):
+                new_state[key] = value
+            if state != None:
+                state.child = new_state
+            state = new_state
+        return state
 
     def gen_checkpoint_heights(self, height):
         ''' Generates the heights of StateDeltas that should be kept.
@@ -1,59 +1,278 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from cryptonet.debug import debug
+
 
 class Database:
-    ''' An in-memory key value store for testing cryptonet '''
+    ''' An in-memory key value store for testing cryptonet
+
+    Data is kept in separate column families:
+        blocks:     block_hash -> block
+        ancestors:  block_hash -> [ancestor 1 above, ancestor 2 above, ancestor 4 above, ...]
+        children:   block_hash -> [child hashes]
+        heights:    block_hash -> height
+        metadata:   name (bytes) -> bytes, e.g. the chainstate
+    and main_chain, a list of block hashes indexed by height.
+    The serialized bytes of recently served blocks are kept in an LRU of at most raw_cache_size bytes, see
+    get_raw_entry.
+    '''
+
+    persistent = False
+
+    def __init__(self, raw_cache_size=32 * 2 ** 20):
+        self.blocks = {}
+        self.ancestors = {}
+        self.children = {}
+        self.heights = {}
+        self.metadata = {}
+        self.main_chain = []  # main_chain[height] is the hash of the main chain's block at that height
+        self.raw_cache_size = raw_cache_size
+        self.raw_cache = OrderedDict()
+        self.raw_cache_bytes = 0
+        self.raw_cache_lock = threading.Lock()
 
-    def __init__(self):
-        ''' Everything is stored in self.key_value_store.
-        Typically keys will be hashes and values will be lists. '''
-        self.key_value_store = {}
+    def key_exists(self, block_hash):
+        return block_hash in self.blocks
 
-    def key_exists(self, key):
-        return key in self.key_value_store
+    def set_entry(self, block_hash, block):
+        self.blocks[block_hash] = block
 
-    def set_entry(self, key, value):
-        self.key_value_store[key] = value
+    def get_entry(self, block_hash):
+        return self.blocks[block_hash]
 
-    def get_entry(self, key):
-        return self.key_value_store[key]
+    def get_raw_entry(self, block_hash):
+        ''' Return the serialized bytes of a block, serializing it only if it isn't in the raw_cache. '''
+        with self.raw_cache_lock:
+            if block_hash in self.raw_cache:
+                self.raw_cache.move_to_end(block_hash)
+                return self.raw_cache[block_hash]
+        value_bytes = self.blocks[block_hash].serialize()
+        with self.raw_cache_lock:
+            if block_hash not in self.raw_cache:
+                self.raw_cache[block_hash] = value_bytes
+                self.raw_cache_bytes += len(value_bytes)
+            while self.raw_cache_bytes > self.raw_cache_size:
+                _, evicted = self.raw_cache.popitem(last=False)
+                self.raw_cache_bytes -= len(evicted)
+        return value_bytes
 
-    def rpush(self, key, val):
-        if key not in self.key_value_store:
-            self.key_value_store[key] = [val]
-        else:
-            self.key_value_store[key].append(val)
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
 
-    def link_ancestor(self, young, old, diff):
-        self.rpush(old + diff, young)
-        self.rpush(young - diff, old)
+    def get_metadata(self, name):
+        return self.metadata.get(name)
 
     def set_ancestors(self, block):
-        s = 0
-        bh = block.get_hash()
-        cur = block.parent_hash
-        if cur == 0: return True  # genesis block
-        self.link_ancestor(bh, cur, 2 ** s)
-        while self.key_exists(cur - 2 ** s):
-            cur = self.get_entry(cur - 2 ** s)[0]  # going backwards will always have only one entry
-            s += 1
-            self.link_ancestor(bh, cur, 2 ** s)
+        ''' Record block's height, its power-of-two ancestor links, and block as a child of its parent. '''
+        ancestors = []
+        if block.parent_hash != 0:  # genesis block has no ancestors
+            ancestors.append(block.parent_hash)
+            # the ancestor 2**(s+1) above block is the ancestor 2**s above block's ancestor 2**s above
+            while len(self.ancestors.get(ancestors[-1], ())) >= len(ancestors):
+                ancestors.append(self.ancestors[ancestors[-1]][len(ancestors) - 1])
+        self._set_links(block.get_hash(), block.height, ancestors)
         return True
 
+    def _set_links(self, block_hash, height, ancestors):
+        self.ancestors[block_hash] = ancestors
+        self.heights[block_hash] = height
+        if len(ancestors) > 0:
+            self.children.setdefault(ancestors[0], []).append(block_hash)
+
+    def get_ancestor_links(self, block_hash):
+        ''' Returns [ancestor 1 above, ancestor 2 above, ancestor 4 above, ...] for block_hash. '''
+        return self.ancestors.get(block_hash, [])
+
     def get_ancestors(self, start):
-        #print('\ngetAncestors : %s\n' % repr(self.d))
+        ''' Returns [start, and the ancestors 1, 1+2, 1+2+4, ... blocks above it], as used for previous_blocks. '''
         ret = [start]
         index = 0
         cur = start
-        if cur == 0:
-            return ret  # genesis block
-        #print('\ngetAncestors subtest : %s\n' % repr(cur - 1))
-        while self.key_exists(cur - 2 ** index):
-            cur = self.get_entry(cur - 2 ** index)[0]
+        while len(self.ancestors.get(cur, ())) > index:
+            cur = self.ancestors[cur][index]
             index += 1
             ret.append(cur)
         return ret
 
+    def get_ancestor(self, block_hash, distance):
+        ''' Follow the power-of-two links made by set_ancestors to the ancestor distance blocks above block_hash.
+        Takes O(log distance) lookups. Returns None if the chain above block_hash is shorter than distance.
+        '''
+        while distance > 0:
+            power = distance.bit_length() - 1
+            links = self.ancestors.get(block_hash, ())
+            if len(links) <= power:
+                return None
+            block_hash = links[power]
+            distance -= 2 ** power
+        return block_hash
+
+    def get_height(self, block_hash):
+        return self.heights.get(block_hash)
+
     def get_children(self, block_hash):
-        ''' block_hash + delta gives all blocks at (height of block_hash) + delta
+        return self.children.get(block_hash)
+
+    def set_main_chain(self, from_height, block_hashes):
+        ''' Replace the main chain from from_height upwards with block_hashes, e.g. after a reorg. '''
+        self.main_chain[from_height:] = block_hashes
+
+    def get_main_chain_hash(self, height):
+        if 0 <= height < len(self.main_chain):
+            return self.main_chain[height]
+
+    def get_main_chain_hashes(self, start, end):
+        ''' Hashes of the main chain's blocks with start <= height < end. '''
+        return self.main_chain[max(start, 0):max(end, 0)]
+
+    def close(self):
+        pass
+
+
+class PersistentDatabase(Database):
+    ''' A persistent key value store backed by an append-only log file.
+
+    Each write appends a record to the log:
+        kind (1 byte) | key (32 bytes) | value length (4 bytes) | value
+    where kind names the column family and key is a block hash, a height, or a metadata name padded with zeros.
+    Blocks are stored as their serialized bytes; self.index maps each block hash to the (offset, length) of those
+    bytes and blocks are decoded with self._Block when read. Decoded blocks are kept in a bounded LRU cache so
+    repeated reads (get_block, assert_validity) only go to disk on a cache miss.
+    Links are logged as height (4 bytes) | ancestor hashes (32 bytes each); ancestors, children and heights are
+    rebuilt from them on replay and kept in memory. Main chain updates are logged as the from_height key and the
+    new hashes. Metadata is small and is also kept in memory.
+    '''
+
+    persistent = True
+
+    KIND_BLOCK = 0
+    KIND_METADATA = 1
+    KIND_LINKS = 2
+    KIND_MAIN_CHAIN = 3
+
+    KEY_LENGTH = 32
+    _RECORD_HEAD = struct.Struct('>B%dsI' % KEY_LENGTH)
+    _HEIGHT = struct.Struct('>I')
+
+    def __init__(self, path, block_class=None, cache_size=1000):
+        super().__init__()
+        self.path = path
+        self._Block = block_class
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.index = {}
+        self.lock = threading.RLock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # 'a+b' creates the file if needed; all writes go to the end regardless of seek position
+        self.log = open(path, 'a+b')
+        self._replay_log()
+
+    def _encode_hashes(self, hashes):
+        return b''.join([h.to_bytes(self.KEY_LENGTH, 'big') for h in hashes])
+
+    def _decode_hashes(self, hashes_bytes):
+        return [int.from_bytes(hashes_bytes[i:i + self.KEY_LENGTH], 'big')
+                for i in range(0, len(hashes_bytes), self.KEY_LENGTH)]
+
+    def _replay_log(self):
+        ''' Rebuild the in memory column families and self.index from the log.
+        A partially written record at the end of the log (e.g. after a crash) is truncated.
         '''
-        if (block_hash + 1) in self.key_value_store:
-            return self.get_entry(block_hash + 1)
+        self.log.seek(0)
+        data = self.log.read()
+        offset = 0
+        while offset + self._RECORD_HEAD.size <= len(data):
+            kind, key_bytes, value_length = self._RECORD_HEAD.unpack_from(data, offset)
+            value_offset = offset + self._RECORD_HEAD.size
+            if value_offset + value_length > len(data):
+                break
+            value = data[value_offset:value_offset + value_length]
+            if kind == self.KIND_BLOCK:
+                self.index[int.from_bytes(key_bytes, 'big')] = (value_offset, value_length)
+            elif kind == self.KIND_METADATA:
+                self.metadata[key_bytes.rstrip(b'\x00')] = value
+            elif kind == self.KIND_LINKS:
+                height, = self._HEIGHT.unpack_from(value)
+                Database._set_links(self, int.from_bytes(key_bytes, 'big'), height,
+                                    self._decode_hashes(value[self._HEIGHT.size:]))
+            elif kind == self.KIND_MAIN_CHAIN:
+                self.main_chain[int.from_bytes(key_bytes, 'big'):] = self._decode_hashes(value)
+            offset = value_offset + value_length
+        if offset < len(data):
+            debug('PersistentDatabase: truncating partial record at %d' % offset)
+            self.log.truncate(offset)
+
+    def _append_record(self, kind, key_bytes, value_bytes):
+        ''' Append a record and return the offset of value_bytes within the log. '''
+        self.log.seek(0, os.SEEK_END)
+        value_offset = self.log.tell() + self._RECORD_HEAD.size
+        self.log.write(self._RECORD_HEAD.pack(kind, key_bytes, len(value_bytes)) + value_bytes)
+        self.log.flush()
+        return value_offset
+
+    def _read_value(self, offset, length):
+        self.log.seek(offset)
+        return self.log.read(length)
+
+    def _cache_put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def key_exists(self, block_hash):
+        return block_hash in self.index
+
+    def set_entry(self, block_hash, block):
+        with self.lock:
+            value_bytes = block.serialize()
+            self._cache_put(block_hash, block)
+            value_offset = self._append_record(self.KIND_BLOCK, block_hash.to_bytes(self.KEY_LENGTH, 'big'),
+                                               value_bytes)
+            self.index[block_hash] = (value_offset, len(value_bytes))
+
+    def get_entry(self, block_hash):
+        with self.lock:
+            if block_hash in self.cache:
+                self.cache_hits += 1
+                self.cache.move_to_end(block_hash)
+                return self.cache[block_hash]
+            value_bytes = self.get_raw_entry(block_hash)
+            self.cache_misses += 1
+            block = self._Block(value_bytes)
+            self._cache_put(block_hash, block)
+            return block
+
+    def get_raw_entry(self, block_hash):
+        ''' Return the serialized bytes of a block, as stored in the log, without decoding it. '''
+        with self.lock:
+            offset, length = self.index[block_hash]
+            return self._read_value(offset, length)
+
+    def set_metadata(self, name, value):
+        ''' name is stored in a KEY_LENGTH byte field, so it can't be longer. '''
+        if len(name) > self.KEY_LENGTH:
+            raise ValueError('metadata name longer than %d bytes: %r' % (self.KEY_LENGTH, name))
+        with self.lock:
+            self._append_record(self.KIND_METADATA, name.ljust(self.KEY_LENGTH, b'\x00'), value)
+            self.metadata[name] = value
+
+    def _set_links(self, block_hash, height, ancestors):
+        with self.lock:
+            self._append_record(self.KIND_LINKS, block_hash.to_bytes(self.KEY_LENGTH, 'big'),
+                                self._HEIGHT.pack(height) + self._encode_hashes(ancestors))
+            super()._set_links(block_hash, height, ancestors)
+
+    def set_main_chain(self, from_height, block_hashes):
+        with self.lock:
+            self._append_record(self.KIND_MAIN_CHAIN, from_height.to_bytes(self.KEY_LENGTH, 'big'),
+                                self._encode_hashes(block_hashes))
+            super().set_main_chain(from_height, block_hashes)
+
+    def close(self):
+        with self.lock:
+            self.log.close()
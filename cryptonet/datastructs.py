@@ -66,7 +66,118 @@ class MerkleBranchToRoot(Encodium):
         return global_hash(msg)
 
 
+class _PatriciaLeaf(object):
+    __slots__ = ('path', 'value_hash', 'hash')
 
+    def __init__(self, path, value_hash):
+        self.path = path
+        self.value_hash = value_hash
+        self.hash = None
+
+    def get_hash(self):
+        if self.hash == None:
+            self.hash = global_hash(b'\x00' + self.path.to_bytes(32, 'big') + self.value_hash.to_bytes(32, 'big'))
+        return self.hash
+
+
+class _PatriciaBranch(object):
+    ''' All paths below a branch share their first self.bit bits (those of self.path); self.left holds the
+    paths whose next bit is 0 and self.right those whose next bit is 1.
+    '''
+    __slots__ = ('bit', 'path', 'left', 'right', 'hash')
+
+    def __init__(self, bit, path, left, right):
+        self.bit = bit
+        self.path = path
+        self.left = left
+        self.right = right
+        self.hash = None
+
+    def get_hash(self):
+        if self.hash == None:
+            self.hash = global_hash(b'\x01' + self.bit.to_bytes(1, 'big') +
+                                    self.left.get_hash().to_bytes(32, 'big') +
+                                    self.right.get_hash().to_bytes(32, 'big'))
+        return self.hash
+
+
+class MerklePatriciaTree(object):
+    ''' An immutable binary Merkle Patricia tree mapping keys to values.
+
+    Keys are placed at path global_hash(key) and only nodes where two paths diverge are stored, so the tree
+    has depth ~log2(n). set() and delete() return a new tree that shares every untouched node with the old one,
+    which makes a tree cheap to hand from a StateDelta to its children. Node hashes are computed lazily and
+    cached, so after k writes get_hash() costs O(k log n) hash operations, and O(1) when nothing has changed.
+    The hash of the empty tree is 0.
+    '''
+
+    PATH_BITS = 256
+
+    def __init__(self, root=None):
+        self.root = root
+
+    @staticmethod
+    def hash_value(value):
+        if isinstance(value, Encodium):
+            return value.get_hash()
+        return global_hash(value)
+
+    def _bit_at(self, path, bit):
+        return (path >> (self.PATH_BITS - 1 - bit)) & 1
+
+    def _first_different_bit(self, path_a, path_b):
+        return self.PATH_BITS - (path_a ^ path_b).bit_length()
+
+    def _join(self, bit, node_a, path_a, node_b, path_b):
+        if self._bit_at(path_a, bit) == 0:
+            return _PatriciaBranch(bit, path_a, node_a, node_b)
+        return _PatriciaBranch(bit, path_a, node_b, node_a)
+
+    def _set(self, node, path, value_hash):
+        if node == None:
+            return _PatriciaLeaf(path, value_hash)
+        if isinstance(node, _PatriciaLeaf):
+            if node.path == path:
+                return _PatriciaLeaf(path, value_hash)
+            return self._join(self._first_different_bit(node.path, path), _PatriciaLeaf(path, value_hash), path,
+                              node, node.path)
+        different_bit = self._first_different_bit(node.path, path)
+        if different_bit < node.bit:
+            # path leaves the common prefix of this branch, so it splits off above it
+            return self._join(different_bit, _PatriciaLeaf(path, value_hash), path, node, node.path)
+        if self._bit_at(path, node.bit) == 0:
+            return _PatriciaBranch(node.bit, node.path, self._set(node.left, path, value_hash), node.right)
+        return _PatriciaBranch(node.bit, node.path, node.left, self._set(node.right, path, value_hash))
+
+    def _delete(self, node, path):
+        if node == None:
+            return None
+        if isinstance(node, _PatriciaLeaf):
+            return None if node.path == path else node
+        if self._first_different_bit(node.path, path) < node.bit:
+            return node
+        if self._bit_at(path, node.bit) == 0:
+            left, right = self._delete(node.left, path), node.right
+        else:
+            left, right = node.left, self._delete(node.right, path)
+        if left is node.left and right is node.right:
+            return node
+        if left == None:
+            return right
+        if right == None:
+            return left
+        return _PatriciaBranch(node.bit, node.path, left, right)
+
+    def set(self, key, value):
+        return MerklePatriciaTree(self._set(self.root, global_hash(key), self.hash_value(value)))
+
+    def delete(self, key):
+        return MerklePatriciaTree(self._delete(self.root, global_hash(key)))
+
+    def get_hash(self):
+        if self.root == None:
+            return 0
+        return self.root.get_hash()
 
 
 MerkleTree = MerkleLeavesToRoot
@@ -210,6 +321,65 @@ class Intro(Encodium):
 
 RequestBlocksMessage = HashList
 BlocksMessage = BytesList
+RequestHeadersMessage = HashList  # a locator: hashes from the requester's best tip back towards genesis
+HeadersMessage = BytesList
+
+
+class CompactBlock(Encodium):
+    ''' A block as its serialized header and uncles plus a short id for each of its super_txs, which the receiver
+    should already have. See Block.to_compact().
+    '''
+    header = Bytes.Definition()
+    uncles = List.Definition(Bytes.Definition(), default=[])
+    short_ids = List.Definition(Integer.Definition(length=8), default=[])
+
+    def get_hash(self):
+        return global_hash(self.serialize())
+
+
+class RequestSuperTxs(Encodium):
+    ''' Asks for the super_txs at indexes in block_hash's block, after receiving it as a CompactBlock. '''
+    block_hash = Integer.Definition(length=32)
+    indexes = List.Definition(Integer.Definition(length=4), default=[])
+
+
+class BlockSuperTxs(Encodium):
+    ''' The serialized super_txs asked for by a RequestSuperTxs, in the order asked for. '''
+    block_hash = Integer.Definition(length=32)
+    super_txs = List.Definition(Bytes.Definition(), default=[])
+
+
+#===============================================================================
+# Chainstate
+#===============================================================================
+
+
+class StateDeltaSnapshot(Encodium):
+    ''' One StateDelta: its own key/value pairs (as parallel lists) and deleted keys.
+    Only integer values can be snapshotted.
+    '''
+    height = Integer.Definition(length=4)
+    keys = List.Definition(Integer.Definition(), default=[])
+    values = List.Definition(Integer.Definition(), default=[])
+    deleted_keys = List.Definition(Integer.Definition(), default=[])
+
+
+class DappStateSnapshot(Encodium):
+    ''' The chain of StateDeltas belonging to one dapp, oldest first. '''
+    name = Bytes.Definition()
+    deltas = List.Definition(StateDeltaSnapshot.Definition(), default=[])
+
+
+class ChainState(Encodium):
+    ''' Everything Chain.load_chain() needs to resume from head without re-applying blocks.
+    tip_priorities[i] is the priority of tips[i].
+    '''
+    head = Integer.Definition(length=32)
+    block_hashes = List.Definition(Integer.Definition(length=32), default=[])
+    tips = List.Definition(Integer.Definition(length=32), default=[])
+    tip_priorities = List.Definition(Integer.Definition(), default=[])
+    invalid_block_hashes = List.Definition(Integer.Definition(length=32), default=[])
+    dapp_states = List.Definition(DappStateSnapshot.Definition(), default=[])
 
 """
 
@@ -1,7 +1,17 @@
+import encodium
+
+
 
 class ValidationError(Exception):
     pass
 
 
+class TemporaryValidationError(ValidationError, encodium.ValidationError):
+    ''' Raised for failures that may pass later, e.g. a timestamp too far in the future, so the data mustn't be
+    remembered as invalid. Caught by handlers of either ValidationError.
+    '''
+    pass
+
+
 class ChainError(Exception):
     pass
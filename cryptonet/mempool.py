@@ -0,0 +1,175 @@
+import heapq
+import itertools
+import threading
+
+from cryptonet.debug import debug
+
+''' mempool.py
+Contains
+    Mempool: unconfirmed super_txs waiting to be mined
+'''
+
+
+class Mempool(object):
+    ''' Unconfirmed SignedSuperTxs, indexed by hash and by sender.
+
+    Super_txs are ranked by fee per byte (the sum of their txs' fees over their serialized size). The pool holds at
+    most max_bytes of serialized super_txs; once full, the lowest fee rate super_txs are evicted to make room, the
+    newest first among equals. ordered() gives the order the future block (the miner's candidate) is assembled in.
+    Confirmed super_txs are removed on each reorganisation and those in disconnected blocks are returned, see
+    reorganise().
+    If short_id (a function of a super_tx's hash, see Block.short_id) is given super_txs are also indexed by short id,
+    for rebuilding compact blocks; see get_by_short_id().
+    Safe to use from several threads.
+    '''
+
+    def __init__(self, max_bytes=32 * 2 ** 20, short_id=None):
+        self.max_bytes = max_bytes
+        self.short_id = short_id
+        self.entries = {}  # super_tx hash -> (super_tx, fee_rate, size, sequence number)
+        self.senders = {}  # sender -> hashes of its super_txs, by sequence number (normally arrival order)
+        self.by_short_id = {}  # short id -> super_tx hash; on a collision the latest wins
+        self.total_bytes = 0
+        self._by_fee_rate = []  # min-heap of (fee_rate, -sequence number, hash); removed entries are skipped lazily
+        self._sequence = itertools.count()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, super_tx_hash):
+        return super_tx_hash in self.entries
+
+    @staticmethod
+    def sender_of(super_tx):
+        return (super_tx.sender.x, super_tx.sender.y)
+
+    @staticmethod
+    def fee_of(super_tx):
+        return sum(tx.fee for tx in super_tx.txs)
+
+    def get(self, super_tx_hash):
+        with self.lock:
+            if super_tx_hash in self.entries:
+                return self.entries[super_tx_hash][0]
+
+    def get_by_short_id(self, short_id):
+        ''' The super_tx with short_id, or None. '''
+        with self.lock:
+            super_tx_hash = self.by_short_id.get(short_id)
+            if super_tx_hash != None:
+                return self.entries[super_tx_hash][0]
+
+    def super_txs(self):
+        with self.lock:
+            return [entry[0] for entry in self.entries.values()]
+
+    def from_sender(self, sender):
+        with self.lock:
+            return [self.entries[h][0] for h in self.senders.get(sender, ())]
+
+    def add(self, super_tx, sequence=None):
+        ''' Add super_tx unless it's already here. Returns the hashes of the super_txs evicted to make room, which
+        include super_tx's own if it pays the lowest fee rate.
+        sequence places super_tx in its sender's queue; by default it goes last, as the newest.
+        '''
+        super_tx_hash = super_tx.get_hash()
+        with self.lock:
+            if super_tx_hash in self.entries:
+                return []
+            size = len(super_tx.serialize())
+            fee_rate = self.fee_of(super_tx) / max(size, 1)
+            if sequence == None:
+                sequence = next(self._sequence)
+            self.entries[super_tx_hash] = (super_tx, fee_rate, size, sequence)
+            queue = self.senders.setdefault(self.sender_of(super_tx), [])
+            position = len(queue)
+            while position > 0 and self.entries[queue[position - 1]][3] > sequence:
+                position -= 1
+            queue.insert(position, super_tx_hash)
+            if self.short_id != None:
+                self.by_short_id[self.short_id(super_tx_hash)] = super_tx_hash
+            self.total_bytes += size
+            heapq.heappush(self._by_fee_rate, (fee_rate, -sequence, super_tx_hash))
+            evicted = []
+            while self.total_bytes > self.max_bytes:
+                evicted.append(self._pop_lowest_fee_rate())
+            if len(evicted) > 0:
+                debug('Mempool: evicted %d super_txs' % len(evicted))
+            return evicted
+
+    def _pop_lowest_fee_rate(self):
+        while True:
+            _, negative_sequence, super_tx_hash = heapq.heappop(self._by_fee_rate)
+            if super_tx_hash in self.entries and self.entries[super_tx_hash][3] == -negative_sequence:
+                self._remove(super_tx_hash)
+                return super_tx_hash
+
+    def _remove(self, super_tx_hash):
+        super_tx, _, size, _ = self.entries.pop(super_tx_hash)
+        self.total_bytes -= size
+        sender = self.sender_of(super_tx)
+        self.senders[sender].remove(super_tx_hash)
+        if len(self.senders[sender]) == 0:
+            del self.senders[sender]
+        if self.short_id != None:
+            short_id = self.short_id(super_tx_hash)
+            if self.by_short_id.get(short_id) == super_tx_hash:
+                del self.by_short_id[short_id]
+
+    def remove(self, super_tx_hashes):
+        with self.lock:
+            for super_tx_hash in super_tx_hashes:
+                if super_tx_hash in self.entries:
+                    self._remove(super_tx_hash)
+            # drop removed entries from the heap once they make up most of it
+            if len(self._by_fee_rate) > 2 * len(self.entries) + 64:
+                self._by_fee_rate = [item for item in self._by_fee_rate
+                                     if item[2] in self.entries and self.entries[item[2]][3] == -item[1]]
+                heapq.heapify(self._by_fee_rate)
+
+    def ordered(self):
+        ''' All super_txs, highest fee rate first except that each sender's are kept in the order they arrived,
+        since later ones may depend on earlier ones.
+        '''
+        with self.lock:
+            queues = {sender: list(hashes) for sender, hashes in self.senders.items()}
+            heads = []
+            for sender, hashes in queues.items():
+                _, fee_rate, _, sequence = self.entries[hashes[0]]
+                heads.append((-fee_rate, sequence, sender, 0))
+            heapq.heapify(heads)
+            ret = []
+            while len(heads) > 0:
+                _, _, sender, index = heapq.heappop(heads)
+                ret.append(self.entries[queues[sender][index]][0])
+                if index + 1 < len(queues[sender]):
+                    _, fee_rate, _, sequence = self.entries[queues[sender][index + 1]]
+                    heapq.heappush(heads, (-fee_rate, sequence, sender, index + 1))
+            return ret
+
+    def reorganise(self, disconnected_blocks, connected_blocks):
+        ''' The main chain lost disconnected_blocks and gained connected_blocks: return the super_txs of the former
+        to the pool and remove those confirmed by the latter.
+        Returned super_txs were created before anything still pending, so they go ahead of every pending super_tx
+        (their sender's included), in the order they were in the chain.
+        '''
+        with self.lock:
+            confirmed = set()
+            for block in connected_blocks:
+                confirmed.update(super_tx.get_hash() for super_tx in block.super_txs)
+            returned = [super_tx for block in disconnected_blocks for super_tx in block.super_txs
+                        if super_tx.get_hash() not in confirmed]
+            first = min([entry[3] for entry in self.entries.values()] + [next(self._sequence)])
+            for i, super_tx in enumerate(returned):
+                self.add(super_tx, sequence=first - len(returned) + i)
+            self.remove(confirmed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'super_txs': len(self.entries),
+                'senders': len(self.senders),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+            }
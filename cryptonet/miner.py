@@ -1,18 +1,72 @@
+import multiprocessing
+import queue
 import threading
 import time
 
 from cryptonet.debug import debug
 from cryptonet.errors import ValidationError
+from cryptonet.verifier import DeferredChecks
+
+
+def _search_nonces(block, nonce, count):
+    ''' Try the next count nonces after nonce, which must be block's current nonce.
+    Blocks providing search_nonces() (see standard.Header) are searched without re-serializing the header for
+    every attempt; other blocks fall back to increment_nonce() and valid_proof().
+    Returns the solution (left set on block) or None.
+    '''
+    if hasattr(block, 'search_nonces'):
+        return block.search_nonces(count)
+    for candidate in range(nonce + 1, nonce + count + 1):
+        block.increment_nonce()
+        if block.valid_proof():
+            return candidate
+    return None
+
+
+def _mine_nonce_range(block_class, serialized_block, first_nonce, last_nonce, stop, results):
+    ''' Runs in a worker process: search nonces in [first_nonce, last_nonce) and put the first that gives a valid
+    proof on results. Module level so it can be the target of a multiprocessing.Process.
+    '''
+    # the parent has already checked the candidate's signatures
+    with DeferredChecks():
+        block = block_class(serialized_block)
+    block.set_nonce(first_nonce)
+    if block.valid_proof():
+        results.put(first_nonce)
+        return
+    nonce = first_nonce
+    while nonce + 1 < last_nonce and not stop.is_set():
+        count = min(Miner.NONCE_BATCH, last_nonce - nonce - 1)
+        solution = _search_nonces(block, nonce, count)
+        if solution != None:
+            results.put(solution)
+            return
+        nonce += count
 
 
 class Miner:
-    def __init__(self, chain, seek_n_build):
+    ''' Mines on top of the chain head and hands solved blocks to SeekNBuild.
+
+    With processes > 1 the nonce space is split into that many disjoint ranges and each range is searched by its
+    own worker process; the block class must then implement set_nonce() and be importable by the workers.
+    '''
+
+    NONCE_BATCH = 4096  # nonces tried between checks for restart/shutdown
+
+    def __init__(self, chain, seek_n_build, processes=1):
         self._shutdown = False
         self._restart = False
+        self._wake = threading.Event()  # set on restart/shutdown so a waiting miner resumes immediately
+        self._restart_requested_at = None
+        self.processes = processes
         self.threads = [threading.Thread(target=self.mine)]
         self.chain = chain
         self.chain.set_miner(self)
         self.seek_n_build = seek_n_build
+        # stale work: time between a restart being requested (e.g. a new head) and mining on the new candidate
+        self.restarts = 0
+        self.last_stale_work_time = 0
+        self.total_stale_work_time = 0
 
     def run(self):
         for t in self.threads:
@@ -20,45 +74,116 @@ class Miner:
 
     def shutdown(self):
         self._shutdown = True
+        self._wake.set()
         for t in self.threads:
             t.join()
 
     def restart(self):
+        if self._restart_requested_at == None:
+            self._restart_requested_at = time.time()
         self._restart = True
+        self._wake.set()
+
+    def stats(self):
+        return {
+            'restarts': self.restarts,
+            'last_stale_work_time': self.last_stale_work_time,
+            'total_stale_work_time': self.total_stale_work_time,
+        }
+
+    def _record_stale_work(self):
+        requested_at, self._restart_requested_at = self._restart_requested_at, None
+        if requested_at == None:
+            return
+        self.restarts += 1
+        self.last_stale_work_time = time.time() - requested_at
+        self.total_stale_work_time += self.last_stale_work_time
+        debug('Miner: stale work %.4fs' % self.last_stale_work_time)
+
+    def _search(self, block):
+        ''' Increment block's nonce until it has a valid proof. Returns False if interrupted by restart/shutdown. '''
+        while not self._shutdown and not self._restart:
+            # the nonce argument only numbers the generic path's results, which are just tested against None here
+            if _search_nonces(block, 0, self.NONCE_BATCH) == None:
+                continue
+            try:
+                block.assert_internal_consistency()
+                return True
+            except ValidationError as e:
+                debug('Miner: invalid block generated: %s' % block.serialize())
+        return False
+
+    def _search_with_workers(self, block):
+        ''' Like _search() but split across self.processes worker processes.
+        Workers are stopped as soon as a solution is found or the miner is restarted.
+        '''
+        nonce_space = getattr(block, 'MAX_NONCE', 2 ** 64 - 1) + 1
+        range_size = nonce_space // self.processes
+        # the last range also takes the nonce_space % processes nonces left over
+        bounds = [i * range_size for i in range(self.processes)] + [nonce_space]
+        serialized_block = block.serialize()
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_mine_nonce_range,
+                                           args=(block.__class__, serialized_block, bounds[i], bounds[i + 1],
+                                                 stop, results),
+                                           daemon=True)
+                   for i in range(self.processes)]
+        for w in workers:
+            w.start()
+        found = False
+        try:
+            while not self._shutdown and not self._restart:
+                try:
+                    nonce = results.get(timeout=0.01)
+                except queue.Empty:
+                    if not any(w.is_alive() for w in workers) and results.empty():
+                        debug('Miner: nonce space exhausted')
+                        break
+                    continue
+                block.set_nonce(nonce)
+                if not block.valid_proof():
+                    continue
+                try:
+                    block.assert_internal_consistency()
+                    found = True
+                    break
+                except ValidationError as e:
+                    debug('Miner: invalid block generated: %s' % block.serialize())
+        finally:
+            stop.set()
+            for w in workers:
+                w.join(1)
+                if w.is_alive():
+                    w.terminate()
+        return found
 
     def mine(self, provided_block=None):
-        print(provided_block)
         while not self._shutdown:
+            # clear before taking the candidate so a head that arrives meanwhile restarts us again
             self._restart = False
-            # TODO: remove this sleep
-            time.sleep(2)
+            self._wake.clear()
             if provided_block == None:
                 block = self.chain.head.get_candidate(self.chain)
             else:
                 block = provided_block
-            count = 0
+            self._record_stale_work()
             debug('miner restarting')
-            while not self._shutdown and not self._restart:
-                count += 1
-                block.increment_nonce()
-                if block.valid_proof():
-                    try:
-                        block.assert_internal_consistency()
-                        break
-                    except ValidationError as e:
-                        debug('Miner: invalid block generated: %s' % block.serialize())
-                        continue
+            if self.processes > 1:
+                found = self._search_with_workers(block)
+            else:
+                found = self._search(block)
             if self._shutdown: break
             provided_block = None
-            if self._restart:
-                self._restart = False
-                time.sleep(0.01)
-                print('miner -restarting')
+            if not found:
+                if not self._restart:
+                    # nonce space exhausted; nothing to do until the candidate changes
+                    self._wake.wait()
                 continue
             debug('Miner: Found Soln : %064x' % block.get_hash())
             if block.height == 0:  # print genesis
                 debug('Miner: ser\'d block: ', block.serialize())
                 break
             self.seek_n_build.add_block(block)
-            while not self._restart and not self._shutdown:
-                time.sleep(0.01)
+            # set_head restarts us once the chain has moved on to the new block
+            self._wake.wait()
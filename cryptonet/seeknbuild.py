@@ -1,9 +1,15 @@
+import asyncio
+import hashlib
 import time
-import queue
 import threading
+import traceback
+from collections import OrderedDict
+
+import encodium
 
 from cryptonet.datastructs import *
 from cryptonet.debug import debug, verbose_debug
+from cryptonet.errors import ValidationError
 
 
 class AtomicIncrementor:
@@ -18,14 +24,395 @@ class AtomicIncrementor:
         return r
 
 
+class OrphanPool(object):
+    ''' Blocks waiting for their parent, indexed by parent_hash so connecting a block releases exactly its
+    waiting children. Holds at most max_size orphans and evicts those older than max_age seconds; evicting takes
+    time proportional to the number of orphans evicted.
+    '''
+
+    def __init__(self, max_size=1000, max_age=600):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.by_parent = {}  # parent_hash -> {block_hash: block}
+        self.added = OrderedDict()  # block_hash -> (time added, parent_hash), oldest first
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.added)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.added
+
+    def add(self, block, now=None):
+        ''' Returns the hashes of any orphans evicted to make room. '''
+        now = time.time() if now == None else now
+        block_hash = block.get_hash()
+        with self.lock:
+            if block_hash in self.added:
+                return []
+            evicted = self._evict_expired(now)
+            while len(self.added) >= self.max_size:
+                evicted.append(self._remove(next(iter(self.added))))
+            self.by_parent.setdefault(block.parent_hash, {})[block_hash] = block
+            self.added[block_hash] = (now, block.parent_hash)
+            return evicted
+
+    def pop_children(self, parent_hash):
+        ''' Remove and return the orphans waiting for parent_hash. '''
+        with self.lock:
+            children = self.by_parent.pop(parent_hash, {})
+            for block_hash in children:
+                del self.added[block_hash]
+            return list(children.values())
+
+    def evict_expired(self, now=None):
+        ''' Returns the hashes of the orphans evicted. '''
+        with self.lock:
+            return self._evict_expired(time.time() if now == None else now)
+
+    def _evict_expired(self, now):
+        evicted = []
+        while len(self.added) > 0:
+            block_hash, (added_at, _) = next(iter(self.added.items()))
+            if added_at + self.max_age > now:
+                break
+            evicted.append(self._remove(block_hash))
+        return evicted
+
+    def _remove(self, block_hash):
+        _, parent_hash = self.added.pop(block_hash)
+        siblings = self.by_parent[parent_hash]
+        del siblings[block_hash]
+        if len(siblings) == 0:
+            del self.by_parent[parent_hash]
+        return block_hash
+
+
+class ReceivedBlocks(object):
+    ''' Digests of recently received serialized blocks, so blocks_handler can drop a block it has already seen
+    without decoding it again. Each digest maps to the block's hash, or to None if the block was rejected on its own
+    merits for good (undecodable, internally inconsistent or badly signed; not a TemporaryValidationError). Holds at
+    most max_size digests, forgetting the oldest first.
+    '''
+
+    REJECTED = None
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.digests = OrderedDict()  # digest -> block_hash or REJECTED
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(serialized_block):
+        return hashlib.sha3_256(serialized_block).digest()
+
+    def __contains__(self, digest):
+        return digest in self.digests
+
+    def get(self, digest):
+        return self.digests.get(digest)
+
+    def add(self, digest, block_hash):
+        with self.lock:
+            self.digests[digest] = block_hash
+            self.digests.move_to_end(digest)
+            while len(self.digests) > self.max_size:
+                self.digests.popitem(last=False)
+
+
+class CompactBlocks(object):
+    ''' Compact blocks waiting for the super_txs we didn't have when they arrived; see Block.to_compact().
+    Each waits at most TIMEOUT seconds; pop_expired() then hands it back so the full block can be requested instead.
+    Holds at most max_size, the oldest being handed back early to make room.
+    '''
+
+    TIMEOUT = 5  # seconds
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self.partial = OrderedDict()  # block_hash -> (compact, super_txs with None where missing, deadline)
+        self.evicted = []  # block hashes dropped to make room, for pop_expired()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.partial)
+
+    def start(self, block_hash, compact, lookup, now=None):
+        ''' Look up compact's short_ids with lookup (short id -> super_tx, or None if unknown).
+        Returns (super_txs, indexes of those missing); if any are missing compact waits for fill().
+        '''
+        super_txs = [lookup(short_id) for short_id in compact.short_ids]
+        missing = [i for i, super_tx in enumerate(super_txs) if super_tx == None]
+        if len(missing) > 0:
+            now = time.time() if now == None else now
+            with self.lock:
+                self.partial.pop(block_hash, None)
+                self.partial[block_hash] = (compact, super_txs, now + self.TIMEOUT)
+                while len(self.partial) > self.max_size:
+                    self.evicted.append(self.partial.popitem(last=False)[0])
+        return super_txs, missing
+
+    def fill(self, block_hash, missing_super_txs):
+        ''' Complete block_hash's super_txs with missing_super_txs, in the order they were missing.
+        Returns (compact, super_txs), or None if block_hash isn't waiting or missing_super_txs doesn't fit.
+        '''
+        with self.lock:
+            if block_hash not in self.partial:
+                return None
+            compact, super_txs, _ = self.partial.pop(block_hash)
+        missing = [i for i, super_tx in enumerate(super_txs) if super_tx == None]
+        if len(missing) != len(missing_super_txs):
+            return None
+        for i, super_tx in zip(missing, missing_super_txs):
+            super_txs[i] = super_tx
+        return compact, super_txs
+
+    def next_deadline(self):
+        ''' The earliest deadline, or None if nothing is waiting. '''
+        with self.lock:
+            if len(self.evicted) > 0:
+                return 0
+            for _, _, deadline in self.partial.values():
+                return deadline
+
+    def pop_expired(self, now=None):
+        ''' Forget the compact blocks whose deadline has passed (or that were evicted) and return their hashes. '''
+        now = time.time() if now == None else now
+        with self.lock:
+            expired, self.evicted = self.evicted, []
+            while len(self.partial) > 0:
+                block_hash, (_, _, deadline) = next(iter(self.partial.items()))
+                if deadline > now:
+                    break
+                del self.partial[block_hash]
+                expired.append(block_hash)
+            return expired
+
+
+class PeerState(object):
+    ''' The block requests in flight to one peer and how well it has answered them.
+
+    capacity is how many requests may be in flight to the peer at once. It grows by one for each block delivered
+    within TARGET_LATENCY, shrinks by one for each slower delivery and halves on a timeout, so a peer's share of
+    requests follows its throughput (capacity / latency) and slow or unresponsive peers are asked for less.
+    '''
+
+    INITIAL_CAPACITY = 16
+    MAX_CAPACITY = 256
+    TARGET_LATENCY = 2  # seconds
+
+    def __init__(self):
+        self.in_flight = set()
+        self.capacity = self.INITIAL_CAPACITY
+        self.latency = None  # moving average, seconds
+        self.delivered_count = 0
+        self.timeout_count = 0
+
+    def free(self):
+        return self.capacity - len(self.in_flight)
+
+    def delivered(self, block_hash, latency):
+        self.in_flight.discard(block_hash)
+        self.delivered_count += 1
+        self.latency = latency if self.latency == None else 0.8 * self.latency + 0.2 * latency
+        if latency <= self.TARGET_LATENCY:
+            self.capacity = min(self.MAX_CAPACITY, self.capacity + 1)
+        else:
+            self.capacity = max(1, self.capacity - 1)
+
+    def timed_out(self, block_hash):
+        self.in_flight.discard(block_hash)
+        self.timeout_count += 1
+        self.capacity = max(1, self.capacity // 2)
+
+    def stats(self):
+        return {
+            'in_flight': len(self.in_flight),
+            'capacity': self.capacity,
+            'latency': self.latency,
+            'delivered': self.delivered_count,
+            'timeouts': self.timeout_count,
+        }
+
+
+class _HeaderOnlyBlock(object):
+    ''' Stands in for a block whose header has been validated but whose body has not arrived yet. '''
+
+    def __init__(self, header):
+        self.header = header
+        self.height = header.height
+        self.parent_hash = header.parent_hash
+
+
+class HeaderChain(object):
+    ''' Headers validated ahead of their block bodies, for headers-first sync.
+
+    Presents the parts of the Chain interface that Header.assert_validity uses (initialized, has_block_hash,
+    get_block and db.get_ancestors), so each header's PoW, previous_blocks and target are checked against known
+    headers and blocks alike without downloading any bodies. Headers are forgotten once their block is in the chain.
+
+    Holds at most max_size headers. Once full, whole branches off the best header's are dropped, least work first.
+    If the best branch alone fills it, the chain is full: further headers are refused until forget() makes room.
+    '''
+
+    MAX_HEADERS = 2000  # per headers message
+
+    def __init__(self, chain, max_size=100000):
+        self.chain = chain
+        self.max_size = max_size
+        self.initialized = True
+        self.db = self
+        self.headers = {}  # block_hash -> header
+        self.links = {}  # block_hash -> power-of-two ancestors, as in Database.ancestors
+        self.children = {}  # block_hash -> hashes of its children among self.headers
+        self.best = None  # hash of the header with the most work
+        self.full = False
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.headers)
+
+    def has_block_hash(self, block_hash):
+        return block_hash in self.headers or self.chain.has_block_hash(block_hash)
+
+    def get_block(self, block_hash):
+        if block_hash in self.headers:
+            return _HeaderOnlyBlock(self.headers[block_hash])
+        return self.chain.get_block(block_hash)
+
+    def _links(self, block_hash):
+        if block_hash in self.links:
+            return self.links[block_hash]
+        return self.chain.db.get_ancestor_links(block_hash)
+
+    def get_ancestors(self, start):
+        ''' As Database.get_ancestors, following header links and then the chain's. '''
+        ret = [start]
+        index = 0
+        cur = start
+        while len(self._links(cur)) > index:
+            cur = self._links(cur)[index]
+            index += 1
+            ret.append(cur)
+        return ret
+
+    def add_header(self, header):
+        ''' Validate header and remember it. Returns False if it was already known or the chain is full.
+        Raises a ValidationError if header is invalid or does not connect to known headers or blocks.
+        '''
+        with self.lock:
+            block_hash = header.get_hash()
+            if self.has_block_hash(block_hash):
+                return False
+            if len(self.headers) >= self.max_size and (self.full or not self._prune()):
+                return False
+            header.assert_internal_consistency()
+            header.assert_validity(self)
+            links = [header.parent_hash]
+            while len(self._links(links[-1])) >= len(links):
+                links.append(self._links(links[-1])[len(links) - 1])
+            self.headers[block_hash] = header
+            self.links[block_hash] = links
+            self.children.setdefault(header.parent_hash, set()).add(block_hash)
+            if self.best == None or header.sigma_diff > self.headers[self.best].sigma_diff:
+                self.best = block_hash
+            return True
+
+    def _best_branch(self):
+        ''' Hashes of the best header and its ancestors among self.headers. '''
+        if self.best == None and len(self.headers) > 0:
+            self.best = max(self.headers, key=lambda block_hash: self.headers[block_hash].sigma_diff)
+        branch = set()
+        block_hash = self.best
+        while block_hash in self.headers:
+            branch.add(block_hash)
+            block_hash = self.headers[block_hash].parent_hash
+        return branch
+
+    def _prune(self):
+        ''' Drop branches off the best one, least work first, until a tenth of max_size is free.
+        Returns False (and marks the chain full) if the best branch alone leaves no room.
+        '''
+        best_branch = self._best_branch()
+        tips = [block_hash for block_hash in self.headers
+                if block_hash not in best_branch and len(self.children.get(block_hash, ())) == 0]
+        tips.sort(key=lambda block_hash: self.headers[block_hash].sigma_diff)
+        target = self.max_size - max(1, self.max_size // 10)
+        for tip in tips:
+            if len(self.headers) <= target:
+                break
+            block_hash = tip
+            # up to where the branch joins another that is kept
+            while block_hash in self.headers and block_hash not in best_branch and \
+                    len(self.children.get(block_hash, ())) == 0:
+                parent_hash = self.headers[block_hash].parent_hash
+                self._remove(block_hash)
+                block_hash = parent_hash
+        debug('HeaderChain: pruned to %d headers' % len(self.headers))
+        self.full = len(self.headers) >= self.max_size
+        return not self.full
+
+    def _remove(self, block_hash):
+        header = self.headers.pop(block_hash)
+        self.links.pop(block_hash, None)
+        siblings = self.children.get(header.parent_hash)
+        if siblings != None:
+            siblings.discard(block_hash)
+            if len(siblings) == 0:
+                del self.children[header.parent_hash]
+
+    def forget(self, block_hash):
+        ''' Called once block_hash's block has been added to the chain.
+        Returns True if this made room in a full chain, so more headers can be requested.
+        '''
+        with self.lock:
+            if block_hash in self.headers:
+                self._remove(block_hash)
+            if self.best == block_hash:
+                self.best = None
+            if self.full and len(self.headers) < self.max_size:
+                self.full = False
+                return True
+            return False
+
+    def get_locator(self):
+        ''' Hashes from the best known header (or the chain head) back to genesis at exponentially growing distances,
+        so a peer can find where our chains diverge.
+        '''
+        with self.lock:
+            tip = self.best if self.best != None else self.chain.head.get_hash()
+            locator = self.get_ancestors(tip)
+        genesis_hash = self.chain.genesis_block.get_hash()
+        if locator[-1] != genesis_hash:
+            locator.append(genesis_hash)
+        return HashList(contents=locator)
+
+
 class SeekNBuild:
     ''' The SeekNBuild class is responsible for attempting to acquire all known
     blocks, and facilitate the Chain object finding the longest PoW chain possible.
 
-    See the block_seeker and chain_builder functions for more info.
+    See the block_seeker and chain_builder coroutines for more info. Both run on self.loop and wait on queues, so
+    nothing wakes up unless there is work to do. All state is only touched from the loop; the public methods may be
+    called from any thread (P2P handlers, the miner) and hand their work to the loop.
+    By default SeekNBuild runs its own loop in a single thread (spore creates its loop privately inside run()); pass
+    loop to run on an already running loop instead.
+
+    Threads: the chain_builder is the only writer of self.chain once running (see Chain). Peers' transports belong to
+    the P2P loop, so every message SeekNBuild sends is handed to that loop by _send() and _broadcast().
+
+    Each wanted block is requested from a single peer, the one with the most free capacity (see PeerState).
+    Requests are tracked in self.in_flight; one that isn't answered within REQUEST_TIMEOUT is requested again from a
+    different peer if there is one. Requests are only broadcast while no peers are known.
+
+    For headers-first sync, headers from peers are validated by self.header_chain (see add_headers) and their
+    block hashes queued for the block_seeker. chain_builder still applies blocks in height order.
     '''
 
-    def __init__(self, p2p, chain):
+    REQUEST_TIMEOUT = 10  # seconds before an unanswered block request is repeated
+    ORPHAN_EVICTION_INTERVAL = 60
+
+    def __init__(self, p2p, chain, loop=None):
         self.p2p = p2p
         self.chain = chain
         self.chain.learn_of_seek_n_build(self)
@@ -33,216 +420,424 @@ class SeekNBuild:
         self.nonces = AtomicIncrementor()
 
         self.future = set()
-        self.future_queue = queue.PriorityQueue()
-        self.present = set()
-        self.present_queue = queue.PriorityQueue()
+        self.in_flight = {}  # block_hash -> (peer, or None if broadcast, time requested)
+        self.tried = {}  # block_hash -> peers whose request for it timed out
         self.past = set()
-        self.past_queue = queue.PriorityQueue()
-        self.past_queue_no_parent = queue.PriorityQueue()
+        self.orphans = OrphanPool()
+        self.received = ReceivedBlocks()
+        self.compact_blocks = CompactBlocks()
+        self._compact_expiry = None  # handle of the call to _expire_compact_blocks, if one is scheduled
         self.done = set()
         self.all = set()
-        self._shutdown = False
 
-        self.future_lock = threading.Lock()
-        self.present_lock = threading.Lock()
-        self.past_lock = threading.Lock()
+        self.header_chain = HeaderChain(chain)
+        self._headers_peer = None  # the peer headers last came from
+        self.peers = {}  # peer -> PeerState
+
+        # sync throughput, see sync_stats()
+        self.sync_started = None
+        self.headers_synced = 0
+        self.blocks_synced = 0
 
         self._funcs = {
             'height': self.chain.get_height,
         }
 
-        self.threads = [threading.Thread(target=self.block_seeker), threading.Thread(target=self.chain_builder)]
-        for t in self.threads:
-            t.start()
+        self._own_loop = loop == None
+        self.loop = asyncio.new_event_loop() if self._own_loop else loop
+        self._tasks = []
+        self.thread = None
+        # the queues must be created on self.loop
+        if self._own_loop:
+            self.loop.run_until_complete(self._create_queues())
+        else:
+            asyncio.run_coroutine_threadsafe(self._create_queues(), self.loop).result()
+
+    async def _create_queues(self):
+        self.future_queue = asyncio.PriorityQueue()  # (height, block_hash)
+        self.past_queue = asyncio.PriorityQueue()  # (height, nonce, block)
+        self.capacity_freed = asyncio.Event()
+
+    def run(self):
+        ''' Start seeking and building; call once the chain has its genesis block. '''
+        if self._own_loop:
+            self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self._main(),))
+            self.thread.start()
+        else:
+            asyncio.run_coroutine_threadsafe(self._main(), self.loop)
+
+    async def _main(self):
+        self._tasks = [self.loop.create_task(c)
+                       for c in (self.block_seeker(), self.chain_builder(), self.orphan_evicter())]
+        try:
+            await asyncio.wait(self._tasks)
+        except asyncio.CancelledError:
+            pass
+
+    def _cancel_tasks(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self._cancel_tasks)
+        if self.thread != None:
+            self.thread.join()
+            self.loop.close()
+
+    def _call(self, function, *args):
+        ''' Run function(*args) on the loop. '''
+        self.loop.call_soon_threadsafe(function, *args)
+
+    def _call_p2p(self, function, *args):
+        ''' Run function(*args) on the P2P loop, which owns the peers' transports; directly if it isn't running
+        (e.g. FakeSpore).
+        '''
+        p2p_loop = getattr(self.p2p, '_loop', None)
+        if p2p_loop == None or p2p_loop.is_closed():
+            self._run_logged(function, *args)
+        else:
+            p2p_loop.call_soon_threadsafe(self._run_logged, function, *args)
+
+    @staticmethod
+    def _run_logged(function, *args):
+        try:
+            function(*args)
+        except Exception:
+            # unanswered requests are repeated after REQUEST_TIMEOUT
+            traceback.print_exc()
+
+    def _send(self, peer, message_type, payload):
+        self._call_p2p(peer.send, message_type, payload)
+
+    def _broadcast(self, message_type, payload):
+        self._call_p2p(self.p2p.broadcast, message_type, payload)
 
     def max_blocks_at_once(self):
         # no reason for special values besides
         return int(max(5, min(500, self.get_chain_height()) // 3))
 
-    def shutdown(self):
-        self._shutdown = True
-        for t in self.threads:
-            t.join()
+    def add_peer(self, peer):
+        self._call(self._add_peer, peer)
+
+    def _add_peer(self, peer):
+        if peer not in self.peers:
+            self.peers[peer] = PeerState()
+            self.capacity_freed.set()
+
+    def remove_peer(self, peer):
+        self._call(self._remove_peer, peer)
+
+    def _remove_peer(self, peer):
+        ''' Forget peer and request whatever was in flight to it from someone else. '''
+        peer_state = self.peers.pop(peer, None)
+        if peer_state == None:
+            return
+        for block_hash in peer_state.in_flight:
+            del self.in_flight[block_hash]
+            self._seek_again(block_hash)
+
+    def _note_synced(self, headers=0, blocks=0):
+        if self.sync_started == None:
+            self.sync_started = time.time()
+        self.headers_synced += headers
+        self.blocks_synced += blocks
+
+    def sync_stats(self):
+        ''' Headers validated and blocks connected since syncing started, with rates per second. '''
+        elapsed = time.time() - self.sync_started if self.sync_started != None else 0
+        return {
+            'headers': self.headers_synced,
+            'blocks': self.blocks_synced,
+            'headers_per_sec': self.headers_synced / elapsed if elapsed > 0 else 0,
+            'blocks_per_sec': self.blocks_synced / elapsed if elapsed > 0 else 0,
+            'orphans': len(self.orphans),
+            'in_flight': len(self.in_flight),
+            'peers': self.peer_stats(),
+        }
+
+    def peer_stats(self):
+        return [peer_state.stats() for peer_state in list(self.peers.values())]
+
+    def get_locator(self):
+        return self.header_chain.get_locator()
+
+    def add_headers(self, peer, headers):
+        self._call(self._add_headers, peer, headers)
+
+    def _add_headers(self, peer, headers):
+        ''' Validate a batch of headers from peer, in order, and queue their blocks to be downloaded.
+        Stops at the first invalid header, or once the header_chain is full. If the batch was full, ask peer for the
+        headers that follow.
+        '''
+        self._headers_peer = peer
+        new_blocks = []
+        for header in headers:
+            try:
+                if self.header_chain.add_header(header):
+                    new_blocks.append((header.height, header.get_hash()))
+                elif self.header_chain.full:
+                    # asked for again once blocks have made room, see _build
+                    break
+            except (ValidationError, encodium.ValidationError) as e:
+                # standard headers raise encodium's ValidationError
+                debug('add_headers: invalid header', e)
+                break
+        self._note_synced(headers=len(new_blocks))
+        self._seek_many_with_priority(new_blocks)
+        debug('add_headers: %d new headers' % len(new_blocks))
+        if len(headers) >= HeaderChain.MAX_HEADERS and len(new_blocks) > 0 and not self.header_chain.full:
+            self._send(peer, 'request_headers', self.get_locator())
+
+    def _free_capacity(self):
+        return sum(max(0, peer_state.free()) for peer_state in self.peers.values())
+
+    def _choose_peer(self, block_hash):
+        ''' The peer with the most free capacity, preferring those that haven't already failed to send block_hash.
+        Returns None if every peer is at capacity.
+        '''
+        available = [peer for peer, peer_state in self.peers.items() if peer_state.free() > 0]
+        tried = self.tried.get(block_hash, ())
+        untried = [peer for peer in available if peer not in tried]
+        candidates = untried if len(untried) > 0 else available
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda peer: self.peers[peer].free())
+
+    def _request_blocks(self, requesting):
+        ''' Request each of requesting (a list of (height, block_hash)) from one peer, sending each peer a single
+        request_blocks message. Hashes no peer has capacity for go back on the future_queue.
+        Broadcasts if no peers are known.
+        '''
+        now = time.time()
+        if len(self.peers) == 0:
+            for _, block_hash in requesting:
+                self._mark_in_flight(block_hash, None, now)
+            self._broadcast('request_blocks', HashList(contents=[h for _, h in requesting]).serialize())
+            return
+        by_peer = {}
+        for height, block_hash in requesting:
+            peer = self._choose_peer(block_hash)
+            if peer == None:
+                self.future_queue.put_nowait((height, block_hash))
+                self.future.add(block_hash)
+                continue
+            self.peers[peer].in_flight.add(block_hash)
+            self._mark_in_flight(block_hash, peer, now)
+            by_peer.setdefault(peer, []).append(block_hash)
+        for peer, block_hashes in by_peer.items():
+            self._send(peer, 'request_blocks', HashList(contents=block_hashes))
+
+    def _mark_in_flight(self, block_hash, peer, now):
+        self.in_flight[block_hash] = (peer, now)
+        self.loop.call_later(self.REQUEST_TIMEOUT, self._request_timed_out, block_hash, peer, now)
 
     def seek_hash_now(self, block_hash):
+        self._call(self._seek_hash_now, block_hash)
+
+    def _seek_hash_now(self, block_hash):
         ''' Add block_hash to queue with priority -1 (will be pulled next).
         '''
         if block_hash == 0: return
         if block_hash not in self.all:
-            with self.future_lock:
-                self.future_queue.put((-1, block_hash))
-                self.future.add(block_hash)
+            self.future_queue.put_nowait((-1, block_hash))
+            self.future.add(block_hash)
 
     def seek_with_priority(self, block_hash_with_height):
+        self._call(self._seek_with_priority, block_hash_with_height)
+
+    def _seek_with_priority(self, block_hash_with_height):
         ''' Add block_hash to future queue with its priority.
         '''
         height, block_hash = block_hash_with_height
         if block_hash == 0: return
         if block_hash not in self.all:
             self.all.add(block_hash)
-            with self.future_lock:
-                self.future_queue.put((height, block_hash))
-                self.future.add(block_hash)
+            self.future_queue.put_nowait((height, block_hash))
+            self.future.add(block_hash)
 
     def seek_many_with_priority(self, block_hashes_with_height):
+        self._call(self._seek_many_with_priority, list(block_hashes_with_height))
+
+    def _seek_many_with_priority(self, block_hashes_with_height):
         ''' Applies each in list to seek_with_priority()
         '''
         for height, block_hash in block_hashes_with_height:
-            self.seek_with_priority((height, block_hash))
-
-    def block_seeker(self):
-        ''' block_seeker() should be in its own thread.
-        block_seeker will run in a loop and:
-        1. Are there any blocks that were requested more than X seconds ago
-            1.1 for each block that was, add it to requesting
-            1.2 throw it away if it is no longer in the self.preset set
-        2. Find the number of blocks to send
-            2.1 get that many from the future_queue
-        3. For each block_hash to request, add it to the present_queue with the time it was requested.
-        4. Pick a random peer and send the request to it.
-        '''
-        while not self._shutdown and not self.chain.initialized:
-            time.sleep(0.1)
-        while not self._shutdown:
-            # we will eventually serialize this so we make it a Field
-            requesting = IntList()
+            self._seek_with_priority((height, block_hash))
 
-            try:
-                with self.present_lock:
-                    oldest_timestamp, oldest_block_hash = self.present_queue.get_nowait()
-                    while oldest_timestamp + 10 < time.time():  # requested >10s ago
-                        if oldest_block_hash in self.present:
-                            if self.chain.has_block_hash(oldest_block_hash) == False:
-                                debug('seeker, block re-request: %064x' % oldest_block_hash)
-                                requesting.append(oldest_block_hash)
-                            else:
-                                with self.present_lock:
-                                    if oldest_block_hash in self.present:
-                                        self.present.remove(oldest_block_hash)
-
-                        oldest_timestamp, oldest_block_hash = self.present_queue.get_nowait()
-                    self.present_queue.put((oldest_timestamp, oldest_block_hash))
-            except queue.Empty:
-                pass
-
-            with self.future_lock:
-                to_get = min(len(self.future), self.max_blocks_at_once()) - requesting.len()
-                if to_get > 0:
-                    # pick some blocks to request
-                    for i in range(to_get):
-                        _, h = self.future_queue.get()
-                        #print('block_seeker: asking for height: ',_)
-                        if h in self.future:
-                            self.future.remove(h)
-                        if _ != 0:
-                            requesting.append(h)
-
-                for h in requesting:
-                    with self.present_lock:
-                        self.present_queue.put((int(time.time()), h))
-                        self.present.add(h)
-
-            if requesting.len() > 0:
-                # TODO : don't broadcast to all nodes, just one
-                self.p2p.broadcast('request_blocks', requesting.serialize())
-                # Borked in spore since asyncio
-                '''some_peer = self.p2p.random_peer()
-                while True:
-                    # ordered carefully
-                    if some_peer == None:
-                        time.sleep(0.01)
-                        some_peer = self.p2p.random_peer()
-                    else:
-                        break
-                some_peer.send('request_blocks', requesting.serialize())
-                some_peer.data['lastmessage'] = time.time()'''
-            else:
-                time.sleep(0.05)
+    def _seek_again(self, block_hash):
+        if not self.chain.has_block_hash(block_hash) and block_hash not in self.past:
+            debug('seeker, block re-request: %064x' % block_hash)
+            self.future_queue.put_nowait((-1, block_hash))
+            self.future.add(block_hash)
+
+    def _request_timed_out(self, block_hash, peer, requested_at):
+        ''' Called REQUEST_TIMEOUT seconds after block_hash was requested from peer. '''
+        if self.in_flight.get(block_hash) != (peer, requested_at):
+            return  # answered, or requested again since
+        del self.in_flight[block_hash]
+        if peer in self.peers:
+            self.peers[peer].timed_out(block_hash)
+            self.tried.setdefault(block_hash, set()).add(peer)
+            self.capacity_freed.set()
+        self._seek_again(block_hash)
+
+    async def block_seeker(self):
+        ''' block_seeker will run in a loop and:
+        1. Wait until some peer can take another request (or no peers are known; requests are then broadcast).
+        2. Wait for a block hash to be wanted.
+        3. Take as many wanted hashes (lowest height first) from the future_queue as peers have capacity for, up to
+           max_blocks_at_once().
+        4. Request each from one peer, re-requesting it elsewhere if it hasn't arrived in REQUEST_TIMEOUT.
+        '''
+        while True:
+            while len(self.peers) > 0 and self._free_capacity() == 0:
+                self.capacity_freed.clear()
+                await self.capacity_freed.wait()
+            requesting = []
+            height, block_hash = await self.future_queue.get()
+            limit = self.max_blocks_at_once()
+            if len(self.peers) > 0:
+                limit = max(1, min(limit, self._free_capacity()))
+            while True:
+                self.future.discard(block_hash)
+                if height != 0 and block_hash not in self.in_flight and block_hash not in self.done:
+                    requesting.append((height, block_hash))
+                if len(requesting) >= limit or self.future_queue.empty():
+                    break
+                height, block_hash = self.future_queue.get_nowait()
+
+            if len(requesting) > 0:
+                try:
+                    self._request_blocks(requesting)
+                except Exception:
+                    # anything marked in flight is re-requested after REQUEST_TIMEOUT
+                    traceback.print_exc()
 
     def get_chain_height(self):
         return self._funcs['height']()
 
     def broadcast_block(self, to_send):
-        self.p2p.broadcast('blocks', to_send.serialize())
+        self._broadcast('blocks', to_send.serialize())
 
-    def add_block(self, block):
+    def is_known(self, block_hash):
+        ''' True if block_hash is in the chain, invalid, or already queued for the chain_builder (orphans included).
+        Safe to call from any thread.
         '''
-        Add a block to the past_queue (ready for chain_builder) if we haven't done so before.
+        return self.chain.has_block_hash(block_hash) or block_hash in self.chain.invalid_block_hashes or \
+            block_hash in self.past or block_hash in self.done
+
+    def add_block(self, block, peer=None):
+        self._call(self._add_block, block, peer)
+
+    def _delivered(self, block_hash, peer):
+        ''' Settle the request for block_hash, crediting the peer it was requested from if that peer sent it. '''
+        request = self.in_flight.pop(block_hash, None)
+        self.tried.pop(block_hash, None)
+        if request == None:
+            return
+        requested_from, requested_at = request
+        if requested_from in self.peers:
+            if peer == None or peer == requested_from:
+                self.peers[requested_from].delivered(block_hash, time.time() - requested_at)
+            else:
+                self.peers[requested_from].in_flight.discard(block_hash)
+            self.capacity_freed.set()
+
+    def _add_block(self, block, peer=None):
+        '''
+        Add a block (sent by peer, if known) to the past_queue (ready for chain_builder) if we haven't done so before.
         '''
         # blocks should be internally consistent at this point
         block_hash = block.get_hash()
-        to_put = (block.height, self.nonces.get_next(), block)
+        self._delivered(block_hash, peer)
+        if block_hash in self.past or block_hash in self.done:
+            return
+        self.past.add(block_hash)
+        self.past_queue.put_nowait((block.height, self.nonces.get_next(), block))
+        self.all.add(block_hash)
 
-        with self.past_lock:
-            if block_hash in self.past or block_hash in self.done:
-                return
-            self.past.add(block_hash)
-            self.past_queue.put(to_put)
+    def watch_compact_blocks(self):
+        ''' Called after a compact block starts waiting in self.compact_blocks, so that it is requested in full if
+        its super_txs don't arrive in time.
+        '''
+        self._call(self._schedule_compact_expiry)
 
-        self.all.add(block_hash)
+    def _schedule_compact_expiry(self):
+        if self._compact_expiry != None:
+            return
+        deadline = self.compact_blocks.next_deadline()
+        if deadline != None:
+            self._compact_expiry = self.loop.call_later(max(0, deadline - time.time()), self._expire_compact_blocks)
 
-        with self.present_lock:
-            try:
-                self.present.remove(block_hash)
-            except KeyError:
-                pass
-
-    def chain_builder(self):
-        '''
-        1. Get the next block.
-        2. If the block is potentially the next block (or older that the chain head)
-            2.1 Check we don't already have it
-            2.2 Ensure it's valid
-            2.3 Add it to the Chain
-            2.4 Broadcast to peers
-        '''
-        while not self._shutdown and not self.chain.initialized:
-            time.sleep(0.1)
-        while not self._shutdown:
+    def _expire_compact_blocks(self):
+        self._compact_expiry = None
+        for block_hash in self.compact_blocks.pop_expired():
+            if not self.is_known(block_hash):
+                debug('seeker, compact block expired: %064x' % block_hash)
+                self._seek_hash_now(block_hash)
+        self._schedule_compact_expiry()
+
+    def _forget_orphans(self, block_hashes):
+        ''' Evicted orphans may be received (and pooled) again later. '''
+        if len(block_hashes) > 0:
+            debug('chain_builder: evicted %d orphans' % len(block_hashes))
+            self.past.difference_update(block_hashes)
+
+    async def orphan_evicter(self):
+        while True:
+            await asyncio.sleep(self.ORPHAN_EVICTION_INTERVAL)
+            self._forget_orphans(self.orphans.evict_expired())
+
+    async def chain_builder(self):
+        '''
+        1. Wait for the next block.
+        2. If we already have it, mark it done.
+        3. If its parent is unknown, put it in the orphan pool until the parent is connected.
+        4. Otherwise
+            4.1 Add it to the Chain (which validates it)
+            4.2 Broadcast to peers, as a compact block if the block class supports it
+            4.3 Queue any orphans that were waiting for it
+        '''
+        while True:
+            height, nonce, block = await self.past_queue.get()
             try:
-                with self.past_lock:
-                    height, nonce, block = self.past_queue.get(timeout=0.1)
-            except queue.Empty:
-                continue
-            if block.height == 0:
-                self.past.remove(block.get_hash())
-                self.done.add(block.get_hash())
-                continue
-            block_hash = block.get_hash()
-            #print('chain_builder: checking %d' % block.height)
-            # TODO : handle orphans intelligently
-            if block.height > self.get_chain_height() + 1:
-                #print('chain_builder: chain height: %d' % self.get_chain_height())
-                #print('chain_builder: block.height %d' % block.height)
-                # try some of those which were parentless:
-                with self.past_lock:
-                    self.past_queue.put((height, nonce, block))
-                    while not self.past_queue_no_parent.empty():
-                        self.past_queue.put(self.past_queue_no_parent.get())
-                time.sleep(0.05)
-            else:
-                if self.chain.has_block(block_hash):
-                    try:
-                        self.past.remove(block_hash)
-                    except KeyError:
-                        pass
-                    self.done.add(block_hash)
-                    continue
-                # TODO : handle orphans intelligently
-                if not self.chain.has_block_hash(block.parent_hash):
-                    debug('chain_builder: don\'t have parent')
-                    debug('chain_builder: head and curr', self.chain.head.get_hash(), block.parent_hash)
-                    with self.past_lock:
-                        self.past_queue_no_parent.put((height, nonce, block))
-                    continue
-                # todo: only broadcast block on success
-                with self.past_lock:
-                    self.past.remove(block_hash)
-                    self.done.add(block_hash)
-                self.chain.add_block(block)
-                debug('builder to send : %064x' % block.get_hash())
-                to_send = BlocksMessage(contents=[block.serialize()])
-                debug('builder sending...')
-                verbose_debug('builder to send full : %s' % to_send.serialize())
-                self.broadcast_block(to_send)
-                debug('builder success : %064x' % block.get_hash())
+                self._build(block)
+            except Exception:
+                # keep building; one bad block mustn't stop the builder
+                traceback.print_exc()
+
+    def _build(self, block):
+        block_hash = block.get_hash()
+        if block.height == 0 or self.chain.has_block_hash(block_hash):
+            self.past.discard(block_hash)
+            self.done.add(block_hash)
+            return
+        if not self.chain.has_block_hash(block.parent_hash) and \
+                block.parent_hash not in self.chain.invalid_block_hashes:
+            debug('chain_builder: don\'t have parent, orphan %064x' % block_hash)
+            self._forget_orphans(self.orphans.add(block))
+            self._seek_hash_now(block.parent_hash)
+            return
+        # todo: only broadcast block on success
+        self.past.remove(block_hash)
+        self.done.add(block_hash)
+        self.chain.add_block(block)
+        if self.header_chain.forget(block_hash) and self._headers_peer in self.peers:
+            self._send(self._headers_peer, 'request_headers', self.get_locator())
+        self._note_synced(blocks=1)
+        debug('builder to send : %064x' % block.get_hash())
+        # also leaves the bytes in the db's raw cache for peers that request this block
+        serialized_block = self.chain.get_serialized_block(block_hash)
+        # peers echoing this block back are then dropped without decoding
+        self.received.add(self.received.digest(serialized_block), block_hash)
+        debug('builder sending...')
+        if hasattr(block, 'to_compact'):
+            # peers rebuild it from super_txs they already have
+            self._broadcast('compact_block', block.to_compact().serialize())
+        else:
+            to_send = BlocksMessage(contents=[serialized_block])
+            verbose_debug('builder to send full : %s' % to_send.serialize())
+            self.broadcast_block(to_send)
+        debug('builder success : %064x' % block.get_hash())
+        for child in self.orphans.pop_children(block_hash):
+            self.past_queue.put_nowait((child.height, self.nonces.get_next(), child))
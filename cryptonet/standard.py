@@ -7,12 +7,15 @@ import ecdsa
 import json
 import hashlib
 import random
+import struct
 
 from cryptonet.utilities import global_hash, time_as_int
 from cryptonet.statemaker import StateMaker
 from cryptonet.rpcserver import RPCServer
-from cryptonet.datastructs import MerkleLeavesToRoot
+from cryptonet.datastructs import MerkleLeavesToRoot, CompactBlock
 from cryptonet.debug import debug
+from cryptonet.verifier import default_verifier, checks_deferred
+from cryptonet.errors import TemporaryValidationError
 import cryptonet
 
 '''
@@ -56,12 +59,16 @@ class Signature(Encodium):
     def assert_valid_signature(self, message):
         '''
         '''
+        cache_key = (global_hash(message), self.to_bytes())
+        if cache_key in default_verifier.cache:
+            return
         # TODO assert pubkey is valid for curve
         if not pycoin.ecdsa.verify(pycoin.ecdsa.generator_secp256k1,
                                    (self.pubkey_x, self.pubkey_y),
                                    global_hash(message),
                                    (self.r, self.s)):
             raise ValidationError('Signature failed to verify')
+        default_verifier.mark_verified(cache_key)
         debug('Signature.assert_valid_signature', message)
 
     def pubkey(self):
@@ -128,6 +135,19 @@ class Point(Encodium):
         return Point(x=point.x(), y=point.y())
 
 
+def verify_super_tx_signature(pubkey_x, pubkey_y, signature, message):
+    ''' Returns True if signature is a valid signature of message by (pubkey_x, pubkey_y).
+    Module level so SignatureVerifier can run it in a worker process.
+    Anything that doesn't verify is invalid, e.g. a pubkey that isn't on the curve (which ecdsa asserts).
+    '''
+    try:
+        point = ecdsa.ellipticcurve.Point(ecdsa.SECP256k1.curve, pubkey_x, pubkey_y)
+        pubkey = ecdsa.VerifyingKey.from_public_point(point, curve=ecdsa.SECP256k1)
+        return pubkey.verify(signature, message)
+    except Exception:
+        return False
+
+
 class SuperTx(Encodium):
     sender = Point.Definition()
     txs = List.Definition(Tx.Definition())
@@ -146,8 +166,15 @@ class SuperTx(Encodium):
             self.txs_bytes
         ])
 
+    def __setattr__(self, name, value):
+        if name != '_hash':
+            super().__setattr__('_hash', None)
+        super().__setattr__(name, value)
+
     def get_hash(self):
-        return global_hash(self.to_bytes())
+        if getattr(self, '_hash', None) == None:
+            self._hash = global_hash(self.to_bytes())
+        return self._hash
 
     def sign(self, secret_exponent):
         privkey = ecdsa.SigningKey.from_secret_exponent(secret_exponent, curve=ecdsa.SECP256k1)
@@ -168,12 +195,23 @@ class SignedSuperTx(SuperTx):
 
     def check(self, changed_attributes):
         super().check(changed_attributes)
-        ecdsa_sender = self.sender._ecdsa_point()
-        try:
-            pubkey = ecdsa.VerifyingKey.from_public_point(ecdsa_sender, curve=ecdsa.SECP256k1)
-            pubkey.verify(self.signature, self.txs_bytes)
-        except ecdsa.keys.BadSignatureError:
+        # blocks being decoded in bulk are verified afterwards by default_verifier.verify_blocks()
+        if checks_deferred():
+            return
+        cache_key, _, args = self.signature_check()
+        if default_verifier.is_verified(cache_key):
+            return
+        if not verify_super_tx_signature(*args):
             raise ValidationError("Invalid Signature")
+        default_verifier.mark_verified(cache_key)
+
+    def signature_check(self):
+        ''' (key, function, args) as expected by SignatureVerifier.
+        The sender isn't part of get_hash() so it must be part of the key, or a verified signature would also
+        vouch for the same txs claimed by another sender.
+        '''
+        return ((self.get_hash(), self.sender.x, self.sender.y, self.signature), verify_super_tx_signature,
+                (self.sender.x, self.sender.y, self.signature, self.txs_bytes))
 
     def sign(secret_exponent):
         raise Exception("This transaction is already signed.")
@@ -189,6 +227,8 @@ class Header(Encodium):
     _TARGET1 = 2 ** 256  # fuck it (see history)
     RETARGET_PERIOD = 16  # Measured in blocks
     BLOCKS_PER_DAY = 28800  # lots of blocks; 144 = 10m; 28800 = 5s; set so low for testing
+    _NONCE_OFFSET = 2  # nonce follows the 2 byte version in to_bytes()
+    _NONCE_STRUCT = struct.Struct('>Q')
 
     version = Integer.Definition(length=2, default=1)
     nonce = Integer.Definition(length=8, default=0)  # nonce second to increase work needed for PoW
@@ -207,6 +247,12 @@ class Header(Encodium):
         self.previous_blocks_with_height = [(self.height - 2 ** i, self.previous_blocks[i]) for i in
                                             range(len(self.previous_blocks))]
 
+    def __setattr__(self, name, value):
+        # any change (e.g. increment_nonce) invalidates the memoized hash
+        if name != '_hash':
+            super().__setattr__('_hash', None)
+        super().__setattr__(name, value)
+
     def to_bytes(self):
         return b''.join([
             self.version.to_bytes(2, 'big'),
@@ -222,7 +268,9 @@ class Header(Encodium):
         ])
 
     def get_hash(self):
-        return global_hash(self.to_bytes())
+        if getattr(self, '_hash', None) == None:
+            self._hash = global_hash(self.to_bytes())
+        return self._hash
 
     def assert_internal_consistency(self):
         # todo: finish
@@ -234,11 +282,13 @@ class Header(Encodium):
 
         'not silly' means the data 'looks' right (length, etc) but the information
         is not validated.
+        The timestamp is checked last since it is the only check that may pass later.
         '''
         self.assert_true(self.version == 1, 'version at 1')
-        self.assert_true(self.timestamp <= int(time.time()) + 60 * 15, 'timestamp too far in future')
         self.assert_true(self.valid_proof(), 'valid PoW required')
         self.assert_true(len(self.previous_blocks) < 30, 'reasonable number of prev_blocks')
+        if self.timestamp > int(time.time()) + 60 * 15:
+            raise TemporaryValidationError('timestamp too far in future')
 
     def assert_validity(self, chain):
         ''' self.assert_validity does not validate merkle roots.
@@ -271,9 +321,31 @@ class Header(Encodium):
     def valid_proof(self):
         return self.get_hash() < self.target
 
+    def search_nonces(self, count):
+        ''' Mining fast path; equivalent to calling increment_nonce() and then valid_proof() up to count times.
+        The header is serialized once and each attempt only patches the nonce bytes, hashes the buffer and
+        compares the digest with the target as bytes.
+        Returns the solution (which is also left in self.nonce) or None with self.nonce advanced by count.
+        '''
+        buffer = bytearray(self.to_bytes())
+        target = self.target.to_bytes(32, 'big')
+        pack_nonce = self._NONCE_STRUCT.pack_into
+        sha3_256 = hashlib.sha3_256
+        first_nonce = self.nonce + 1
+        for nonce in range(first_nonce, first_nonce + count):
+            pack_nonce(buffer, self._NONCE_OFFSET, nonce)
+            if sha3_256(buffer).digest() < target:
+                self.nonce = nonce
+                return nonce
+        self.nonce = first_nonce + count - 1
+        return None
+
     def increment_nonce(self):
         self.nonce += 1
 
+    def set_nonce(self, nonce):
+        self.nonce = nonce
+
     # todo: test
     def get_pre_candidate(self, chain, previous_block):
         new_header = Header(
@@ -328,15 +400,21 @@ class Header(Encodium):
 
 
 class Block(Encodium):
+    MAX_NONCE = 2 ** 64 - 1  # Header.nonce is 8 bytes
+
     header = Header.Definition()
     uncles = List.Definition(Header.Definition(), default=[])
-    super_txs = List.Definition(SuperTx.Definition(), default=[])
+    super_txs = List.Definition(SignedSuperTx.Definition(), default=[])
+
+    HEADER_CLASS = Header  # enables headers-first sync
+    SUPER_TX_CLASS = SignedSuperTx  # enables compact block relay
+    SHORT_ID_BITS = 64
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.parent_hash = self.header.previous_blocks[0]
         self.height = self.header.height
-        self.priority = self.height
+        self.priority = self.header.sigma_diff  # exact integer work, as compared by better_than
         self.state_maker = None
         self.super_state = None
 
@@ -381,7 +459,33 @@ class Block(Encodium):
         return self.header.get_hash()
 
     def __hash__(self):
-        return global_hash(self.serialize())
+        # consistent with __eq__, and cheap since the header memoizes its hash
+        return self.get_hash()
+
+    def signature_checks(self):
+        ''' Signatures in this block, for SignatureVerifier.verify_blocks(). '''
+        return [super_tx.signature_check() for super_tx in self.super_txs]
+
+    @classmethod
+    def short_id(cls, super_tx):
+        ''' The leading SHORT_ID_BITS of super_tx's hash, which identify it in a CompactBlock. '''
+        return cls.short_id_of_hash(super_tx.get_hash())
+
+    @classmethod
+    def short_id_of_hash(cls, super_tx_hash):
+        return super_tx_hash >> (256 - cls.SHORT_ID_BITS)
+
+    def to_compact(self):
+        return CompactBlock(header=self.header.serialize(), uncles=[uncle.serialize() for uncle in self.uncles],
+                            short_ids=[self.short_id(super_tx) for super_tx in self.super_txs])
+
+    @classmethod
+    def from_compact(cls, compact, super_txs):
+        ''' Rebuild a block from a CompactBlock and the super_txs its short_ids stand for, in order.
+        A short id collision leaves transaction_mr wrong, so assert_internal_consistency() should follow.
+        '''
+        return cls(header=cls.HEADER_CLASS(compact.header),
+                   uncles=[cls.HEADER_CLASS(uncle) for uncle in compact.uncles], super_txs=super_txs)
 
     #def add_super_txs(self, list_of_super_txs):
     #    self.state_maker.add_super_txs(list_of_super_txs)
@@ -447,6 +551,12 @@ class Block(Encodium):
     def increment_nonce(self):
         self.header.increment_nonce()
 
+    def set_nonce(self, nonce):
+        self.header.set_nonce(nonce)
+
+    def search_nonces(self, count):
+        return self.header.search_nonces(count)
+
     def valid_proof(self):
         return self.header.valid_proof()
 
@@ -500,6 +610,28 @@ class RCPHandler:
                 "difficulty": Header.target_to_diff(chain.head.header.target),
             }
 
+        @rpc.add_method
+        def get_main_chain_hashes(start, end):
+            return chain.get_main_chain_hashes(start, end)
+
+        @rpc.add_method
+        def get_sync_stats():
+            return self.cryptonet.seek_n_build.sync_stats()
+
+        @rpc.add_method
+        def get_signature_cache_stats():
+            return default_verifier.cache.stats()
+
+        @rpc.add_method
+        def get_miner_stats():
+            if chain.miner == None:
+                return {}
+            return chain.miner.stats()
+
+        @rpc.add_method
+        def get_mempool_stats():
+            return self.state_maker.mempool.stats()
+
         @rpc.add_method
         def get_balance(pubkey_x):
             assert isinstance(pubkey_x, int)
@@ -515,10 +647,8 @@ class RCPHandler:
         def push_tx(signed_super_tx):
             try:
                 super_tx = SignedSuperTx.from_obj(signed_super_tx)
-                super_tx.assert_internal_consistency()
-                self.state_maker.apply_super_tx_to_future(super_tx)
-                chain.restart_miner()
-                p2p.broadcast(b'super_tx', super_tx)
+                if self.cryptonet.accept_super_tx(super_tx):
+                    p2p.broadcast('super_tx', super_tx)
             except Exception as e:
                 import traceback
                 traceback.print_exc()
@@ -1,8 +1,11 @@
+import encodium
+
 from cryptonet.utilities import global_hash
 from cryptonet.dapp import Dapp, TxPrism, TxTracker
 from cryptonet.errors import ValidationError
 from cryptonet.dapp import StateDelta
 from cryptonet.debug import debug
+from cryptonet.mempool import Mempool
 from cryptonet.datastructs import MerkleLeavesToRoot
 from cryptonet.constants import ROOT_DAPP, TX_TRACKER
 
@@ -66,6 +69,13 @@ class _DappHolder(object):
         for d in self.dapps:
             self.dapps[d].forget_alt(state_tag)
 
+    def snapshot(self):
+        return [self.dapps[d].snapshot() for d in self.dapps]
+
+    def restore(self, dapp_states):
+        for dapp_state in dapp_states:
+            self.dapps[dapp_state.name].restore(dapp_state)
+
     def generate_super_state(self):
         debug('Generating super state')
         super_state = SuperState()
@@ -87,6 +97,8 @@ class StateMaker(object):
         self.is_future = is_future
         self.future_state_maker = None
         self.future_block = None
+        # unconfirmed super_txs; the future block is rebuilt from these on every new head
+        self.mempool = Mempool(short_id=getattr(chain._Block, 'short_id_of_hash', None))
         self._Block = chain._Block
 
     def register_dapp(self, new_dapp):
@@ -115,23 +127,76 @@ class StateMaker(object):
         if block.height != 0:
             self.checkpoint(hard_checkpoint)
 
-    def _block_events(self, block):
+    def _block_events(self, block, update_roots=True):
         ''' What is done every time a block is received - operates directly on current state.
         '''
         block._set_state_maker(self)
         self.dapps.on_block(block, self.chain)
         self._add_super_txs(block.super_txs)
-        block.update_roots()
+        if update_roots:
+            block.update_roots()
 
     def apply_super_tx_to_future(self, super_tx):
-        ''' This applies a transaction to future_block.
+        ''' This adds a transaction to the mempool and applies it to future_block.
          The state will be updated and a new block available when pushed to the miner.
-         - This is equivalent to adding the tx to the mem-pool
+         Returns False if super_tx was already pending, was evicted straight away for its low fee rate, or can't be
+         applied (it is then dropped).
          '''
+        return len(self.apply_super_txs_to_future([super_tx])) == 1
+
+    def apply_super_txs_to_future(self, super_txs):
+        ''' As apply_super_tx_to_future for a batch; future_block's roots are updated once for the whole batch.
+        Returns the super_txs applied.
+        '''
+        added = []
+        evicted = set()
+        for super_tx in super_txs:
+            if super_tx.get_hash() in self.mempool:
+                continue
+            evicted.update(self.mempool.add(super_tx))
+            added.append(super_tx)
+        if any(super_tx.get_hash() in evicted for super_tx in self.future_block.super_txs):
+            # evicted super_txs are already in future_block
+            self._refresh_future_block(self.most_recent_block)
+            return [super_tx for super_tx in added if super_tx.get_hash() in self.mempool]
+        added = [super_tx for super_tx in added if super_tx.get_hash() not in evicted]
+        if len(added) == 0:
+            return []
         with self.future_state():
-            self._add_super_txs([super_tx])
-            self.future_block.super_txs.append(super_tx)
-            self.future_block.update_roots()
+            return self._apply_to_future(added)
+
+    def _apply_to_future(self, super_txs):
+        ''' Apply super_txs to the future state and append them to future_block, then update its roots and
+        future_super_state once. Must be called within self.future_state().
+        Each super_tx gets its own (soft) checkpoint, so one that can't be applied is rolled back on its own while
+        the rest of the batch carries on. Those that failed are tried again after the rest, since they may depend
+        on a super_tx that came after them (e.g. spend funds it sends); once a pass applies nothing new, the ones
+        still failing are dropped from the mempool. Returns the super_txs applied.
+        '''
+        applied = []
+        remaining = list(super_txs)
+        while len(remaining) > 0:
+            failed = []
+            for super_tx in remaining:
+                self.checkpoint(hard_checkpoint=False)
+                try:
+                    # resets to the checkpoint above on failure
+                    self._add_super_txs([super_tx])
+                except (AssertionError, ValidationError, encodium.ValidationError) as e:
+                    failed.append((super_tx, e))
+                    continue
+                self.future_block.super_txs.append(super_tx)
+                applied.append(super_tx)
+            if len(failed) == len(remaining):
+                for super_tx, e in failed:
+                    debug('StateMaker: dropping pending super_tx %064x' % super_tx.get_hash(), e)
+                    self.mempool.remove([super_tx.get_hash()])
+                break
+            remaining = [super_tx for super_tx, _ in failed]
+        self.future_block.update_roots()
+        # This will hold a copy of the future states of dapps (now in new deltas); forgotten on next refresh.
+        self.future_super_state = self.dapps.generate_super_state()
+        return applied
 
     def _add_super_txs(self, list_of_super_txs):
         ''' Process a list of transactions, typically passes each to the ROOT_DAPP in sequence.
@@ -141,7 +206,8 @@ class StateMaker(object):
                 self.dapps[TX_TRACKER].on_transaction(super_tx, self.most_recent_block, self.chain)
                 for tx in super_tx.txs:
                     self._process_tx(tx)
-        except AssertionError or ValidationError as e:
+        except (AssertionError, ValidationError, encodium.ValidationError) as e:
+            # dapps raise encodium's ValidationError
             self.reset_to_last_hardened_checkpoint()
             raise e
         return True
@@ -166,6 +232,18 @@ class StateMaker(object):
         ''' Apply to all dapps. '''
         self.dapps.make_last_checkpoint_hard()
 
+    def snapshot(self):
+        ''' Snapshot the hardened state of all dapps; see Chain.save_chain(). '''
+        return self.dapps.snapshot()
+
+    def restore(self, dapp_states, head):
+        ''' Restore all dapp states from a snapshot taken when head was the head of the chain, then rebuild
+        the future block on top of head. See Chain.load_chain().
+        '''
+        self.dapps.restore(dapp_states)
+        self.most_recent_block = head
+        self._refresh_future_block(head)
+
     def reorganisation(self, chain, from_block, around_block, to_block, is_test=False):
         ''' self.reorganisation() should be called on current head, where to_block is
         to become the new head of the chain.
@@ -189,6 +267,10 @@ class StateMaker(object):
         if not success and not is_test:
             chain.recursively_mark_invalid(chain_path_to_trial[-1].get_hash())
         if not is_test and success:
+            disconnected_blocks = []
+            if from_block.get_hash() != around_block.get_hash():
+                disconnected_blocks = chain.construct_chain_path(around_block.get_hash(), from_block.get_hash())
+            self.mempool.reorganise(disconnected_blocks, chain_path_to_trial)
             self._refresh_future_block(to_block)
             self.most_recent_block = to_block
         return success
@@ -197,16 +279,15 @@ class StateMaker(object):
         ''' Should be called on .reorganisation() to ensure unconfirmed transactions are remembered (if still legit).
         Will create an unvalidated block to store keep track of future state and the rest of it. Everything within
         future_block will be temporary and discarded and recalculated on the arrival of every new block.
+        The future state starts as an empty delta on top of new_head's state, so only the future block's own events
+        and the mempool's super_txs (as one batch, in mempool.ordered() order) are applied to it; super_txs that no
+        longer apply are dropped. The roots are calculated once, at the end.
         '''
         self.forget_future_state()
         self.future_block = new_head.get_pre_candidate(self.chain)
         with self.future_state():
-            # calc tx_root and state_root
-            # do stuff like update state here with any as yet excluded txs
-            # and only add txs not included in last block, etc
-            self._block_events(self.future_block)
-            # This will hold a copy of the future states of dapps; forgotten on next refresh.
-            self.future_super_state = self.dapps.generate_super_state()
+            self._block_events(self.future_block, update_roots=False)
+            self._apply_to_future(self.mempool.ordered())
 
 
     def _trial_chain_path(self, around_state_height, chain_path_to_trial):
@@ -314,6 +395,6 @@ class SuperState(object):
         for n in names:
             leaves.extend([global_hash(n), self.state_dict[n].get_hash()])
         merkle_root = MerkleLeavesToRoot(leaves=leaves)
-        debug('SuperState: root: ', merkle_root.get_hash(), [self.state_dict[n].complete_kvs() for n in names])
+        debug('SuperState: root: ', merkle_root.get_hash())
         return merkle_root.get_hash()
 
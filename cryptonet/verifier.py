@@ -0,0 +1,143 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptonet.debug import debug
+
+''' verifier.py
+
+Provides SignatureVerifier: verifies the signatures in a batch of blocks across a pool of processes and
+remembers what has already been verified (in a SignatureCache), so a signature checked on relay isn't checked
+again in a block.
+'''
+
+_local = threading.local()
+
+
+def checks_deferred():
+    ''' True inside `with DeferredChecks():` on this thread; signature checks should then be left to a
+    SignatureVerifier.
+    '''
+    return getattr(_local, 'deferred', False)
+
+
+class DeferredChecks(object):
+    ''' Used with the `with` statement while decoding blocks that will be passed to SignatureVerifier.verify_blocks().
+    '''
+
+    def __enter__(self):
+        self.previous = checks_deferred()
+        _local.deferred = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.deferred = self.previous
+
+
+def _run_check(check):
+    ''' A check that raises fails, rather than failing the whole batch. '''
+    key, function, args = check
+    try:
+        return function(*args)
+    except Exception:
+        return False
+
+
+class SignatureCache(object):
+    ''' A bounded LRU set of signatures known to be valid.
+    Keys identify the message, the signer and the signature, e.g. (message hash, pubkey x, pubkey y, signature), so
+    the same signature over a different message or claimed by a different signer is never a hit.
+    '''
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key):
+        with self.lock:
+            self.entries[key] = True
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class SignatureVerifier(object):
+    ''' Blocks provide their signatures via block.signature_checks(), a list of (key, function, args) where
+    function(*args) returns True if the signature is valid and key identifies the message, signer and signature
+    (see SignatureCache).
+    function must be defined at module level so it can be sent to a worker process.
+    '''
+
+    def __init__(self, processes=None, cache_size=100000):
+        self.processes = processes
+        self.pool = None
+        self.cache = SignatureCache(cache_size)
+        self.lock = threading.Lock()
+
+    def is_verified(self, key):
+        return key in self.cache
+
+    def mark_verified(self, key):
+        self.cache.add(key)
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool == None:
+                self.pool = ProcessPoolExecutor(self.processes)
+            return self.pool
+
+    def verify_blocks(self, blocks):
+        ''' Verify every unverified signature in blocks, in parallel.
+        Returns a list of booleans: True where all of that block's signatures are valid.
+        '''
+        checks_per_block = []
+        to_run = {}
+        for block in blocks:
+            checks = block.signature_checks() if hasattr(block, 'signature_checks') else []
+            checks_per_block.append([key for key, _, _ in checks])
+            for check in checks:
+                if not self.is_verified(check[0]):
+                    to_run[check[0]] = check
+        checks = list(to_run.values())
+        if len(checks) == 1:
+            results = [_run_check(checks[0])]
+        elif len(checks) > 1:
+            results = list(self._get_pool().map(_run_check, checks, chunksize=max(1, len(checks) // 64)))
+        else:
+            results = []
+        failed = set()
+        for (key, _, _), result in zip(checks, results):
+            if result:
+                self.mark_verified(key)
+            else:
+                failed.add(key)
+        debug('SignatureVerifier: verified %d signatures, %d failed' % (len(checks), len(failed)))
+        return [not failed.intersection(keys) for keys in checks_per_block]
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool != None:
+                self.pool.shutdown()
+                self.pool = None
+
+
+# shared by SignedSuperTx.check, Signature.assert_valid_signature, blocks_handler and the chain
+default_verifier = SignatureVerifier()
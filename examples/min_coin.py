@@ -36,6 +36,7 @@ parser.add_argument('-network_debug', action='store_true', default=False)
 parser.add_argument('-debug', action='store_true', default=False)
 parser.add_argument('-port', nargs=1, default=[32555], type=int, help='port for node to bind to')
 parser.add_argument('-rpc_port', nargs=1, default=[12345], type=int, help='port for rpc server to bind to')
+parser.add_argument('-mining_processes', nargs=1, default=[1], type=int, help='number of processes to mine with')
 args = parser.parse_args()
 
 if args.debug:
@@ -45,7 +46,8 @@ seeds = [(h, int(p)) for h, p in [i.split(':') for i in args.add_nodes]]
 
 print(args)
 
-min_coin = Cryptonet(mine=args.mine, seeds=seeds, address=('0.0.0.0', args.port[0]), block_class=cryptonet.standard.Block)
+min_coin = Cryptonet(mine=args.mine, seeds=seeds, address=('0.0.0.0', args.port[0]), block_class=cryptonet.standard.Block,
+                     mining_processes=args.mining_processes[0])
 
 rpc = cryptonet.standard.RCPHandler(min_coin, args.rpc_port[0])
 
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from cryptonet.chain import Chain
+from cryptonet.dapp import Dapp
+from cryptonet.database import PersistentDatabase
+from cryptonet.statemaker import SuperState, _DappHolder
+
+
+class SerialBlock(object):
+    ''' Just enough of a block for a Chain on a PersistentDatabase; counts how many are decoded. '''
+
+    _STRUCT = struct.Struct('>32s32sI')
+    decoded = 0
+
+    def __init__(self, serialized=None, block_hash=None, parent_hash=0, height=0):
+        if serialized != None:
+            SerialBlock.decoded += 1
+            hash_bytes, parent_bytes, height = self._STRUCT.unpack(serialized)
+            block_hash, parent_hash = int.from_bytes(hash_bytes, 'big'), int.from_bytes(parent_bytes, 'big')
+        self.block_hash = block_hash
+        self.parent_hash = parent_hash
+        self.height = height
+        self.priority = height
+
+    def serialize(self):
+        return self._STRUCT.pack(self.block_hash.to_bytes(32, 'big'), self.parent_hash.to_bytes(32, 'big'),
+                                 self.height)
+
+    def get_hash(self):
+        return self.block_hash
+
+    def on_genesis(self, chain):
+        pass
+
+    def assert_validity(self, chain):
+        pass
+
+    def better_than(self, other):
+        return other == None or self.priority > other.priority
+
+    def reorganisation(self, chain, from_block, around_block, to_block):
+        return True
+
+
+class LedgerStateMaker(object):
+    ''' The part of a StateMaker that Chain.save_chain() and load_chain() use, with a single dapp. '''
+
+    def __init__(self):
+        self.dapps = _DappHolder()
+        self.super_state = SuperState()
+        self.ledger = Dapp(b'ledger', self)
+
+    def register_dapp(self, dapp):
+        self.dapps[dapp.name] = dapp
+
+    def snapshot(self):
+        return self.dapps.snapshot()
+
+    def restore(self, dapp_states, head):
+        self.dapps.restore(dapp_states)
+
+
+class LedgerBlock(SerialBlock):
+    ''' A SerialBlock whose reorganisations record each new head, by height, in the ledger dapp. '''
+
+    state_maker = None
+
+    def on_genesis(self, chain):
+        self._set_state_maker(LedgerStateMaker())
+
+    def _set_state_maker(self, state_maker):
+        self.state_maker = state_maker
+
+    def reorganisation(self, chain, from_block, around_block, to_block):
+        self.state_maker.ledger.state[to_block.height] = to_block.get_hash()
+        to_block._set_state_maker(self.state_maker)
+        return True
+
+
+class TestRestart(unittest.TestCase):
+    ''' Test restarting a Chain from a PersistentDatabase
+    To Test:
+    * the main chain index is kept and only the head is decoded
+    * the head, tips with their priorities, invalid hashes, main chain and dapp state of a forked chain are restored
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'blocks.log')
+        self.genesis_hash = 2 ** 255
+        self.chain = self.open_chain()
+
+    def open_chain(self):
+        self.db = PersistentDatabase(self.path, LedgerBlock)
+        chain = Chain(db=self.db, block_class=LedgerBlock)
+        chain.set_genesis(LedgerBlock(block_hash=self.genesis_hash))
+        chain.load_chain()
+        return chain
+
+    def extend(self, parent, count, step=1):
+        blocks = []
+        for i in range(count):
+            block = LedgerBlock(block_hash=parent.get_hash() + step, parent_hash=parent.get_hash(),
+                                height=parent.height + 1)
+            self.chain.add_block(block)
+            blocks.append(block)
+            parent = block
+        return blocks
+
+    def test_restart_decodes_only_the_head(self):
+        blocks = self.extend(self.chain.genesis_block, 100)
+        self.chain.save_chain()
+        self.db.close()
+        SerialBlock.decoded = 0
+        self.chain = self.open_chain()
+        self.assertEqual(SerialBlock.decoded, 1)  # the head, by load_chain
+        self.assertEqual(self.chain.head.get_hash(), blocks[-1].get_hash())
+        self.assertEqual(self.chain.get_main_chain_hashes(0, 200),
+                         [self.genesis_hash] + [block.get_hash() for block in blocks])
+
+    def test_restart_restores_chain_state(self):
+        blocks = self.extend(self.chain.genesis_block, 10)
+        fork = self.extend(blocks[4], 3, step=2 ** 20)
+        invalid = self.extend(blocks[1], 2, step=2 ** 40)
+        self.chain.recursively_mark_invalid(invalid[0].get_hash())
+        ledger = self.chain.head.state_maker.ledger.state.complete_kvs()
+        self.chain.save_chain()
+        self.db.close()
+        SerialBlock.decoded = 0
+        self.chain = self.open_chain()
+        self.assertEqual(SerialBlock.decoded, 1)
+        self.assertEqual(self.chain.head.get_hash(), blocks[-1].get_hash())
+        self.assertEqual(sorted(self.chain.tips.items()),
+                         sorted([(blocks[-1].get_hash(), 10), (fork[-1].get_hash(), 8)]))
+        self.assertEqual(self.chain.invalid_block_hashes, set(block.get_hash() for block in invalid))
+        self.assertNotIn(invalid[-1].get_hash(), self.chain.block_hashes)
+        self.assertIn(fork[-1].get_hash(), self.chain.block_hashes)
+        self.assertEqual(self.chain.get_main_chain_hashes(0, 20),
+                         [self.genesis_hash] + [block.get_hash() for block in blocks])
+        self.assertEqual(self.chain.head.state_maker.ledger.state.complete_kvs(), ledger)
+        self.assertEqual(ledger[10], blocks[-1].get_hash())
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cryptonet.database import Database, PersistentDatabase
+
+
+class FakeBlock(object):
+    ''' Just enough of a block for the database: serialize() and construction from bytes. '''
+
+    def __init__(self, serialized):
+        self.serialized = serialized
+
+    def serialize(self):
+        return self.serialized
+
+
+class CountingBlock(FakeBlock):
+
+    def __init__(self, serialized):
+        super().__init__(serialized)
+        self.serialize_count = 0
+
+    def serialize(self):
+        self.serialize_count += 1
+        return self.serialized
+
+
+class TestDatabase(unittest.TestCase):
+    ''' Test Database
+    To Test:
+    * serialized blocks are cached, and the cache is bounded by size in bytes
+    '''
+
+    def test_raw_cache(self):
+        db = Database(raw_cache_size=10)
+        blocks = [CountingBlock(bytes([i]) * 4) for i in range(3)]
+        for i, block in enumerate(blocks):
+            db.set_entry(i, block)
+        self.assertEqual(db.get_raw_entry(0), b'\x00' * 4)
+        self.assertEqual(db.get_raw_entry(0), b'\x00' * 4)
+        self.assertEqual(blocks[0].serialize_count, 1)
+        db.get_raw_entry(1)
+        db.get_raw_entry(2)
+        self.assertEqual(list(db.raw_cache), [1, 2])
+        self.assertEqual(db.raw_cache_bytes, 8)
+        db.get_raw_entry(0)
+        self.assertEqual(blocks[0].serialize_count, 2)
+
+
+class TestPersistentDatabase(unittest.TestCase):
+    ''' Test PersistentDatabase
+    To Test:
+    * blocks, metadata and links survive reopening
+    * decoded blocks are cached, and the cache is bounded
+    * a partially written record is discarded
+    * the main chain index survives reopening
+    * metadata names longer than KEY_LENGTH are refused rather than truncated
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'blocks.log')
+        self.db = PersistentDatabase(self.path, FakeBlock, cache_size=2)
+
+    def reopen(self):
+        self.db.close()
+        self.db = PersistentDatabase(self.path, FakeBlock, cache_size=2)
+
+    def test_entries_survive_reopen(self):
+        self.db.set_entry(1234, FakeBlock(b'block one'))
+        self.db.set_metadata(b'chainstate', b'raw bytes')
+        self.reopen()
+        self.assertTrue(self.db.key_exists(1234))
+        self.assertEqual(self.db.get_entry(1234).serialize(), b'block one')
+        self.assertEqual(self.db.get_raw_entry(1234), b'block one')
+        self.assertEqual(self.db.get_metadata(b'chainstate'), b'raw bytes')
+        self.assertEqual(self.db.get_metadata(b'other'), None)
+        self.assertFalse(self.db.key_exists(4321))
+
+    def test_long_metadata_name_refused(self):
+        name = b'x' * PersistentDatabase.KEY_LENGTH
+        self.db.set_metadata(name, b'fits')
+        with self.assertRaises(ValueError):
+            self.db.set_metadata(name + b'y', b'truncated')
+        self.reopen()
+        self.assertEqual(self.db.get_metadata(name), b'fits')
+
+    def test_bounded_cache(self):
+        for i in range(5):
+            self.db.set_entry(i, FakeBlock(bytes([i])))
+        self.assertEqual(len(self.db.cache), 2)
+        self.db.get_entry(4)
+        self.assertEqual(self.db.cache_hits, 1)
+        self.db.get_entry(0)
+        self.assertEqual(self.db.cache_misses, 1)
+        self.assertEqual(self.db.get_entry(0).serialize(), b'\x00')
+
+    def test_ancestors_and_children(self):
+        class Linked(object):
+            def __init__(self, block_hash, parent_hash, height):
+                self.block_hash, self.parent_hash, self.height = block_hash, parent_hash, height
+
+            def get_hash(self):
+                return self.block_hash
+
+        hashes = [2 ** 200 + i * 2 ** 100 for i in range(6)]
+        for i in range(len(hashes)):
+            self.db.set_ancestors(Linked(hashes[i], hashes[i - 1] if i > 0 else 0, i))
+        self.db.set_ancestors(Linked(hashes[2] + 1, hashes[2], 3))
+        self.reopen()
+        self.assertEqual(self.db.get_ancestors(hashes[5]), [hashes[5], hashes[4], hashes[2]])
+        self.assertEqual(self.db.get_ancestor(hashes[5], 5), hashes[0])
+        self.assertEqual(self.db.get_ancestor(hashes[5], 6), None)
+        self.assertEqual(self.db.get_height(hashes[4]), 4)
+        self.assertEqual(self.db.get_children(hashes[2]), [hashes[3], hashes[2] + 1])
+        self.assertEqual(self.db.get_children(hashes[3] + 1), None)
+
+    def test_main_chain_survives_reopen(self):
+        self.db.set_main_chain(0, [10, 11, 12, 13])
+        self.db.set_main_chain(2, [22])  # reorg above height 1
+        self.reopen()
+        self.assertEqual(self.db.get_main_chain_hashes(0, 10), [10, 11, 22])
+        self.assertEqual(self.db.get_main_chain_hash(2), 22)
+        self.assertEqual(self.db.get_main_chain_hash(3), None)
+
+    def test_partial_record_discarded(self):
+        self.db.set_entry(1, FakeBlock(b'complete'))
+        self.db.close()
+        with open(self.path, 'ab') as log:
+            log.write(b'\x00\x01\x02\x00\x00')
+        self.db = PersistentDatabase(self.path, FakeBlock)
+        self.assertEqual(self.db.get_entry(1).serialize(), b'complete')
+        self.db.set_entry(2, FakeBlock(b'after'))
+        self.reopen()
+        self.assertEqual(self.db.get_entry(2).serialize(), b'after')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+if __name__ == '__main__':
+    unittest.main()
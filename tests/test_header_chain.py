@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import random
+import unittest
+
+import encodium
+
+from cryptonet.chain import Chain
+from cryptonet.database import Database
+from cryptonet.seeknbuild import HeaderChain
+
+
+class FakeHeader(object):
+    ''' Validates connectivity the way standard.Header.assert_validity does. '''
+
+    def __init__(self, block_hash, parent_hash, height, previous_blocks, sigma_diff=None):
+        self.block_hash = block_hash
+        self.parent_hash = parent_hash
+        self.height = height
+        self.previous_blocks = previous_blocks
+        self.sigma_diff = height if sigma_diff == None else sigma_diff
+
+    def get_hash(self):
+        return self.block_hash
+
+    def assert_internal_consistency(self):
+        pass
+
+    def assert_validity(self, chain):
+        if not all(chain.has_block_hash(h) for h in self.previous_blocks):
+            raise encodium.ValidationError('previous_blocks required to be known')
+        if chain.db.get_ancestors(self.parent_hash) != self.previous_blocks:
+            raise encodium.ValidationError('previous blocks must match expected')
+        if chain.get_block(self.parent_hash).height + 1 != self.height:
+            raise encodium.ValidationError('Height requirement')
+
+
+class FakeBlock(object):
+
+    def __init__(self, header):
+        self.header = header
+        self.height = header.height
+        self.parent_hash = header.parent_hash
+
+    def get_hash(self):
+        return self.header.get_hash()
+
+
+class TestHeaderChain(unittest.TestCase):
+    ''' Test HeaderChain
+    To Test:
+    * headers extending known blocks and headers are accepted, with previous_blocks checked across both
+    * headers that don't connect are rejected
+    * the locator runs from the best header back to genesis
+    * once max_size is reached branches with less work are dropped, then headers are refused until there is room
+    '''
+
+    def setUp(self):
+        self.random = random.Random(7)
+        self.db = Database()
+        self.chain = Chain(db=self.db)
+        self.genesis = self.add_block(None)
+        self.chain.genesis_block = self.chain.head = self.genesis
+        self.blocks = [self.genesis]
+        for i in range(5):
+            self.blocks.append(self.add_block(self.blocks[-1]))
+        self.header_chain = HeaderChain(self.chain)
+
+    def make_header(self, parent_hash, height, ancestors):
+        return FakeHeader(self.random.getrandbits(256), parent_hash, height, ancestors)
+
+    def add_block(self, parent):
+        if parent == None:
+            block = FakeBlock(self.make_header(0, 0, [0]))
+        else:
+            block = FakeBlock(self.make_header(parent.get_hash(), parent.height + 1,
+                                               self.db.get_ancestors(parent.get_hash())))
+        self.db.set_entry(block.get_hash(), block)
+        self.db.set_ancestors(block)
+        self.chain.block_hashes.add(block.get_hash())
+        return block
+
+    def extend_headers(self, parent_hash, parent_height, count):
+        headers = []
+        for i in range(count):
+            header = self.make_header(parent_hash, parent_height + 1, self.header_chain.get_ancestors(parent_hash))
+            self.assertTrue(self.header_chain.add_header(header))
+            headers.append(header)
+            parent_hash, parent_height = header.get_hash(), header.height
+        return headers
+
+    def test_headers_extend_blocks_and_headers(self):
+        headers = self.extend_headers(self.blocks[-1].get_hash(), self.blocks[-1].height, 20)
+        self.assertEqual(self.header_chain.best, headers[-1].get_hash())
+        self.assertFalse(self.header_chain.add_header(headers[3]))
+        locator = self.header_chain.get_locator()
+        self.assertEqual(locator[0], headers[-1].get_hash())
+        self.assertEqual(locator[locator.len() - 1], self.genesis.get_hash())
+        self.header_chain.forget(headers[-1].get_hash())
+        self.assertEqual(self.header_chain.best, None)
+
+    def test_bad_headers_rejected(self):
+        with self.assertRaises(encodium.ValidationError):
+            self.header_chain.add_header(self.make_header(12345, 1, [12345]))
+        parent = self.blocks[-1]
+        with self.assertRaises(encodium.ValidationError):
+            self.header_chain.add_header(self.make_header(parent.get_hash(), parent.height + 1, [parent.get_hash()]))
+        self.assertEqual(len(self.header_chain.headers), 0)
+
+    def test_bounded(self):
+        self.header_chain.max_size = 20
+        tip = self.blocks[-1]
+        best = self.extend_headers(tip.get_hash(), tip.height, 12)
+        side = self.extend_headers(self.blocks[2].get_hash(), self.blocks[2].height, 8)
+        self.assertEqual(len(self.header_chain), 20)
+        # room is made by dropping the side branch, which has less work
+        best += self.extend_headers(best[-1].get_hash(), best[-1].height, 8)
+        self.assertEqual(len(self.header_chain), 20)
+        self.assertTrue(all(not self.header_chain.has_block_hash(h.get_hash()) for h in side))
+        self.assertTrue(all(self.header_chain.has_block_hash(h.get_hash()) for h in best))
+        # the best branch alone fills it
+        header = self.make_header(best[-1].get_hash(), best[-1].height + 1,
+                                  self.header_chain.get_ancestors(best[-1].get_hash()))
+        self.assertFalse(self.header_chain.add_header(header))
+        self.assertTrue(self.header_chain.full)
+        self.assertEqual(len(self.header_chain), 20)
+        # until a block arrives
+        self.chain.block_hashes.add(best[0].get_hash())
+        self.assertTrue(self.header_chain.forget(best[0].get_hash()))
+        self.assertTrue(self.header_chain.add_header(header))
+        self.assertEqual(self.header_chain.best, header.get_hash())
+
+
+if __name__ == '__main__':
+    unittest.main()
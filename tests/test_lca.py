@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import random
+import unittest
+
+from cryptonet.chain import Chain, TipSet
+from cryptonet.database import Database
+from cryptonet.errors import ChainError
+
+
+class FakeBlock(object):
+    ''' Just enough of a block for Chain.find_lca and Chain.construct_chain_path. '''
+
+    def __init__(self, block_hash, parent, height):
+        self.block_hash = block_hash
+        self.parent_hash = parent.get_hash() if parent != None else 0
+        self.parent = parent
+        self.height = height
+        self.priority = height
+
+    def get_hash(self):
+        return self.block_hash
+
+    def reorganisation(self, chain, from_block, around_block, to_block):
+        return True
+
+
+class TestSkipListLCA(unittest.TestCase):
+    ''' Test find_lca and construct_chain_path over the db's power-of-two ancestor links.
+    To Test:
+    * find_lca agrees with walking parents on a random block tree
+    * construct_chain_path returns (start, end] and rejects non-ancestors
+    * blocks from different chains have no LCA
+    * the main chain index follows set_head through reorgs
+    * invalidating a subtree deeper than the recursion limit evicts every descendant
+    '''
+
+    def setUp(self):
+        self.db = Database()
+        self.chain = Chain(db=self.db)
+        self.random = random.Random(5)
+        self.blocks = [self.add_block(None)]
+
+    def add_block(self, parent):
+        block = FakeBlock(self.random.getrandbits(256), parent, 0 if parent == None else parent.height + 1)
+        self.db.set_entry(block.get_hash(), block)
+        self.db.set_ancestors(block)
+        return block
+
+    def naive_lca(self, a, b):
+        ancestors = set()
+        while a != None:
+            ancestors.add(a.get_hash())
+            a = a.parent
+        while b.get_hash() not in ancestors:
+            b = b.parent
+        return b
+
+    def test_find_lca_matches_parent_walk(self):
+        for i in range(300):
+            parent = self.blocks[-1] if self.random.random() < 0.7 else self.random.choice(self.blocks)
+            self.blocks.append(self.add_block(parent))
+        for i in range(200):
+            a, b = self.random.choice(self.blocks), self.random.choice(self.blocks)
+            self.assertIs(self.chain.find_lca(a.get_hash(), b.get_hash()), self.naive_lca(a, b))
+
+    def test_construct_chain_path(self):
+        for i in range(20):
+            self.blocks.append(self.add_block(self.blocks[-1]))
+        fork = self.add_block(self.blocks[5])
+        path = self.chain.construct_chain_path(self.blocks[3].get_hash(), self.blocks[20].get_hash())
+        self.assertEqual(path, self.blocks[4:21])
+        self.assertEqual(self.chain.construct_chain_path(fork.get_hash(), fork.get_hash()), [])
+        with self.assertRaises(ChainError):
+            self.chain.construct_chain_path(fork.get_hash(), self.blocks[20].get_hash())
+        with self.assertRaises(ChainError):
+            self.chain.construct_chain_path(self.blocks[20].get_hash(), self.blocks[3].get_hash())
+
+    def test_different_chains(self):
+        other = self.add_block(None)
+        for i in range(3):
+            self.blocks.append(self.add_block(self.blocks[-1]))
+            other = self.add_block(other)
+        with self.assertRaises(ChainError):
+            self.chain.find_lca(self.blocks[-1].get_hash(), other.get_hash())
+
+    def test_main_chain_index_follows_reorgs(self):
+        self.chain.set_head(self.blocks[0])
+        self.chain.initialized = True
+        for i in range(10):
+            self.blocks.append(self.add_block(self.blocks[-1]))
+        self.chain.set_head(self.blocks[-1])
+        self.assertEqual(self.chain.get_main_chain_hashes(0, 100), [b.get_hash() for b in self.blocks])
+        fork = [self.add_block(self.blocks[4])]
+        for i in range(7):
+            fork.append(self.add_block(fork[-1]))
+        self.chain.set_head(fork[-1])
+        expected = [b.get_hash() for b in self.blocks[:5] + fork]
+        self.assertEqual(self.chain.get_main_chain_hashes(0, 100), expected)
+        self.assertIs(self.chain.get_block_at_height(6), fork[1])
+        self.assertEqual(self.chain.get_block_at_height(13), None)
+        self.chain.set_head(self.blocks[3])
+        self.assertEqual(self.chain.get_main_chain_hashes(0, 100), expected[:4])
+
+    def test_invalidate_deep_subtree(self):
+        for i in range(3000):
+            self.blocks.append(self.add_block(self.blocks[-1]))
+        side = self.add_block(self.blocks[10])
+        for block in self.blocks + [side]:
+            self.chain.block_hashes.add(block.get_hash())
+        self.chain.tips.add(self.blocks[-1].get_hash(), self.blocks[-1].priority)
+        self.chain.tips.add(side.get_hash(), side.priority)
+        self.assertEqual(self.chain.recursively_mark_invalid(self.blocks[11].get_hash()), len(self.blocks) - 11)
+        self.assertIn(self.blocks[-1].get_hash(), self.chain.invalid_block_hashes)
+        self.assertIn(side.get_hash(), self.chain.block_hashes)
+        self.assertEqual(self.chain.tips.best(), side.get_hash())
+        self.assertEqual(len(self.chain.tips), 1)
+        self.assertEqual(self.chain.recursively_mark_invalid(self.blocks[11].get_hash()), 0)
+
+
+class TestTipSet(unittest.TestCase):
+
+    def test_matches_sorted_reference(self):
+        rng = random.Random(3)
+        tips = TipSet()
+        reference = {}
+        for i in range(2000):
+            if reference and rng.random() < 0.4:
+                block_hash = rng.choice(list(reference))
+                del reference[block_hash]
+                self.assertTrue(tips.remove(block_hash))
+            else:
+                block_hash = rng.getrandbits(256)
+                reference[block_hash] = rng.randrange(2 ** 300)  # beyond float precision
+                tips.add(block_hash, reference[block_hash])
+            best = max(reference, key=lambda h: (reference[h], -h)) if reference else None
+            self.assertEqual(tips.best(), best)
+            self.assertEqual(len(tips), len(reference))
+        self.assertFalse(tips.remove(12345))
+        self.assertEqual(sorted(tips.items()), sorted(reference.items()))
+
+
+if __name__ == '__main__':
+    unittest.main()
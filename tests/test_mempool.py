@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from cryptonet.mempool import Mempool
+
+
+class FakePoint(object):
+
+    def __init__(self, x):
+        self.x = x
+        self.y = 0
+
+
+class FakeTx(object):
+
+    def __init__(self, fee):
+        self.fee = fee
+
+
+class FakeSuperTx(object):
+
+    def __init__(self, super_tx_hash, sender, fee, size=100):
+        self.super_tx_hash = super_tx_hash
+        self.sender = FakePoint(sender)
+        self.txs = [FakeTx(fee)]
+        self.size = size
+
+    def get_hash(self):
+        return self.super_tx_hash
+
+    def serialize(self):
+        return bytes(self.size)
+
+
+class FakeBlock(object):
+
+    def __init__(self, super_txs):
+        self.super_txs = super_txs
+
+
+class TestMempool(unittest.TestCase):
+    ''' Test Mempool
+    To Test:
+    * super_txs are ordered by fee rate, each sender's kept in arrival order
+    * the lowest fee rate super_txs are evicted once max_bytes is exceeded
+    * a reorganisation returns disconnected super_txs and removes confirmed ones
+    * returned super_txs go ahead of those still pending from the same sender
+    * super_txs are found by short id until they are removed
+    '''
+
+    def test_ordered_by_fee_rate(self):
+        mempool = Mempool()
+        a1, a2 = FakeSuperTx(1, 'a', fee=10), FakeSuperTx(2, 'a', fee=50)
+        b1 = FakeSuperTx(3, 'b', fee=30)
+        c1 = FakeSuperTx(4, 'c', fee=30, size=50)
+        for super_tx in [a1, a2, b1, c1]:
+            self.assertEqual(mempool.add(super_tx), [])
+        self.assertEqual(mempool.add(b1), [])
+        self.assertEqual(len(mempool), 4)
+        # a2 pays the most but must follow a1
+        self.assertEqual(mempool.ordered(), [c1, b1, a1, a2])
+        self.assertEqual(mempool.from_sender(Mempool.sender_of(a1)), [a1, a2])
+        mempool.remove([1])
+        self.assertEqual(mempool.ordered(), [c1, a2, b1])
+        self.assertEqual(mempool.get(2), a2)
+        self.assertEqual(mempool.get(1), None)
+
+    def test_eviction(self):
+        mempool = Mempool(max_bytes=300)
+        for i, fee in enumerate([20, 10, 30]):
+            self.assertEqual(mempool.add(FakeSuperTx(i, i, fee)), [])
+        self.assertEqual(mempool.add(FakeSuperTx(3, 3, 40)), [1])
+        self.assertEqual(mempool.add(FakeSuperTx(4, 4, 5)), [4])
+        self.assertEqual(sorted(mempool.entries), [0, 2, 3])
+        self.assertEqual(mempool.total_bytes, 300)
+
+    def test_reorganise(self):
+        mempool = Mempool()
+        pending, confirmed, returned = FakeSuperTx(1, 'a', 1), FakeSuperTx(2, 'b', 1), FakeSuperTx(3, 'c', 1)
+        mempool.add(pending)
+        mempool.add(confirmed)
+        mempool.reorganise([FakeBlock([returned, confirmed])], [FakeBlock([confirmed])])
+        self.assertIn(1, mempool)
+        self.assertNotIn(2, mempool)
+        self.assertIn(3, mempool)
+        self.assertEqual(mempool.stats()['super_txs'], 2)
+
+    def test_returned_super_txs_keep_their_place(self):
+        mempool = Mempool()
+        a1, a2, a3 = FakeSuperTx(1, 'a', 1), FakeSuperTx(2, 'a', 1), FakeSuperTx(3, 'a', 50)
+        mempool.add(a3)
+        mempool.reorganise([FakeBlock([a1]), FakeBlock([a2])], [])
+        self.assertEqual(mempool.from_sender(Mempool.sender_of(a1)), [a1, a2, a3])
+        self.assertEqual(mempool.ordered(), [a1, a2, a3])
+
+    def test_short_ids(self):
+        mempool = Mempool(short_id=lambda super_tx_hash: super_tx_hash % 10)
+        a, b, c = FakeSuperTx(11, 'a', 1), FakeSuperTx(12, 'b', 1), FakeSuperTx(21, 'c', 1)
+        for super_tx in [a, b, c]:
+            mempool.add(super_tx)
+        self.assertEqual(mempool.get_by_short_id(2), b)
+        self.assertEqual(mempool.get_by_short_id(1), c)  # collides with a; the latest wins
+        mempool.remove([11, 12])
+        self.assertEqual(mempool.get_by_short_id(1), c)
+        self.assertEqual(mempool.get_by_short_id(2), None)
+        self.assertEqual(mempool.by_short_id, {1: 21})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import hashlib
+import time
+import unittest
+
+from cryptonet.miner import Miner
+
+
+class NeverSolvedBlock:
+    def increment_nonce(self):
+        pass
+
+    def valid_proof(self):
+        return False
+
+
+class LowDifficultyBlock:
+    MAX_NONCE = 1000  # 1001 nonces don't split evenly between 2 processes
+    TARGET = 2 ** 252
+
+    def __init__(self, serialized=b'low difficulty'):
+        self.data = serialized
+        self.nonce = 0
+
+    def serialize(self):
+        return self.data
+
+    def set_nonce(self, nonce):
+        self.nonce = nonce
+
+    def increment_nonce(self):
+        self.nonce += 1
+
+    def valid_proof(self):
+        digest = hashlib.sha3_256(self.data + self.nonce.to_bytes(8, 'big')).digest()
+        return int.from_bytes(digest, 'big') < self.TARGET
+
+    def assert_internal_consistency(self):
+        pass
+
+
+class LastNonceBlock(LowDifficultyBlock):
+
+    def valid_proof(self):
+        return self.nonce == self.MAX_NONCE
+
+
+class FakeHead:
+    def get_candidate(self, chain):
+        return NeverSolvedBlock()
+
+
+class FakeChain:
+    def __init__(self):
+        self.head = FakeHead()
+
+    def set_miner(self, miner):
+        self.miner = miner
+
+
+class TestMiner(unittest.TestCase):
+    ''' Test Miner
+    To Test:
+    * a restart (e.g. on a new head) is picked up promptly and counted as stale work
+    * shutdown stops the mining thread
+    '''
+
+    def test_restart_is_picked_up_promptly(self):
+        chain = FakeChain()
+        miner = Miner(chain, seek_n_build=None)
+        miner.run()
+        try:
+            time.sleep(0.05)
+            chain.miner.restart()
+            for _ in range(100):
+                if miner.restarts == 1:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(miner.stats()['restarts'], 1)
+            self.assertLess(miner.last_stale_work_time, 0.5)
+        finally:
+            miner.shutdown()
+        self.assertFalse(miner.threads[0].is_alive())
+
+
+class TestMiningWorkers(unittest.TestCase):
+    ''' Test Miner with several worker processes
+    To Test:
+    * a low difficulty block is mined with 2 processes and its nonce is valid
+    * the last range reaches the end of the nonce space
+    '''
+
+    def test_mine_with_two_processes(self):
+        miner = Miner(FakeChain(), seek_n_build=None, processes=2)
+        block = LowDifficultyBlock()
+        self.assertTrue(miner._search_with_workers(block))
+        self.assertTrue(block.valid_proof())
+        check = LowDifficultyBlock(block.serialize())
+        check.set_nonce(block.nonce)
+        self.assertTrue(check.valid_proof())
+
+    def test_last_nonce_searched(self):
+        miner = Miner(FakeChain(), seek_n_build=None, processes=2)
+        block = LastNonceBlock()
+        self.assertTrue(miner._search_with_workers(block))
+        self.assertEqual(block.nonce, LastNonceBlock.MAX_NONCE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from cryptonet.seeknbuild import OrphanPool
+
+
+class FakeBlock(object):
+
+    def __init__(self, block_hash, parent_hash):
+        self.block_hash = block_hash
+        self.parent_hash = parent_hash
+
+    def get_hash(self):
+        return self.block_hash
+
+
+class TestOrphanPool(unittest.TestCase):
+    ''' Test OrphanPool
+    To Test:
+    * only the children of a connected block are released
+    * the pool is bounded, evicting the oldest orphans first
+    * orphans older than max_age are evicted
+    '''
+
+    def test_pop_children(self):
+        pool = OrphanPool()
+        pool.add(FakeBlock(2, 1), now=0)
+        pool.add(FakeBlock(3, 1), now=0)
+        pool.add(FakeBlock(4, 2), now=0)
+        self.assertEqual(sorted(b.get_hash() for b in pool.pop_children(1)), [2, 3])
+        self.assertEqual(pool.pop_children(1), [])
+        self.assertEqual(len(pool), 1)
+        self.assertIn(4, pool)
+
+    def test_size_limit(self):
+        pool = OrphanPool(max_size=3)
+        for i in range(3):
+            self.assertEqual(pool.add(FakeBlock(10 + i, i), now=i), [])
+        self.assertEqual(pool.add(FakeBlock(20, 0), now=3), [10])
+        self.assertEqual(len(pool), 3)
+        self.assertEqual([b.get_hash() for b in pool.pop_children(0)], [20])
+
+    def test_age_limit(self):
+        pool = OrphanPool(max_age=10)
+        pool.add(FakeBlock(1, 0), now=0)
+        pool.add(FakeBlock(2, 0), now=5)
+        self.assertEqual(pool.evict_expired(now=9), [])
+        self.assertEqual(pool.evict_expired(now=12), [1])
+        self.assertEqual(pool.evict_expired(now=15), [2])
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.by_parent, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+import time
+import unittest
+
+from cryptonet.seeknbuild import SeekNBuild, PeerState, ReceivedBlocks, CompactBlocks
+
+
+class FakeBlock(object):
+
+    def __init__(self, block_hash, parent_hash, height):
+        self.block_hash = block_hash
+        self.parent_hash = parent_hash
+        self.height = height
+
+    def get_hash(self):
+        return self.block_hash
+
+    def serialize(self):
+        return self.block_hash.to_bytes(32, 'big')
+
+
+class FakeChain(object):
+
+    def __init__(self):
+        self.initialized = True
+        self.block_hashes = {1}
+        self.invalid_block_hashes = set()
+        self.added = []
+        self.all_added = threading.Event()
+
+    def learn_of_seek_n_build(self, seek_n_build):
+        pass
+
+    def get_height(self):
+        return len(self.block_hashes) - 1
+
+    def has_block_hash(self, block_hash):
+        return block_hash in self.block_hashes
+
+    def get_serialized_block(self, block_hash):
+        return block_hash.to_bytes(32, 'big')
+
+    def add_block(self, block):
+        self.block_hashes.add(block.get_hash())
+        self.added.append(block.get_hash())
+        if len(self.added) == 5:
+            self.all_added.set()
+
+
+class FakeP2P(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def broadcast(self, method, payload):
+        self.sent.append(method)
+
+
+class FakePeer(object):
+
+    def __init__(self):
+        self.requested = []
+        self.received = threading.Event()
+        self.send_threads = set()
+
+    def send(self, method, payload):
+        self.send_threads.add(threading.current_thread())
+        if method == 'request_blocks':
+            self.requested.extend(payload.contents)
+            self.received.set()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestSeekNBuild(unittest.TestCase):
+    ''' Test SeekNBuild on its event loop
+    To Test:
+    * blocks received out of order are connected in order, orphans waiting for their parent
+    * a missing parent is requested from peers
+    * each wanted block is requested from exactly one peer
+    * a timed out request is repeated to a different peer, and the slow peer's capacity shrinks
+    * messages are sent from the P2P loop's thread
+    * a compact block whose super_txs don't arrive in time is requested in full
+    '''
+
+    def setUp(self):
+        self.chain = FakeChain()
+        self.p2p = FakeP2P()
+        self.seek_n_build = SeekNBuild(self.p2p, self.chain)
+        self.seek_n_build.run()
+
+    def tearDown(self):
+        self.seek_n_build.shutdown()
+
+    def test_out_of_order_blocks_connected(self):
+        blocks = [FakeBlock(i + 2, i + 1, i + 1) for i in range(5)]
+        for block in blocks[:0:-1]:
+            self.seek_n_build.add_block(block)
+        self.assertTrue(wait_for(lambda: 'request_blocks' in self.p2p.sent))
+        self.seek_n_build.add_block(blocks[0])
+        self.assertTrue(self.chain.all_added.wait(5))
+        self.assertEqual(self.chain.added, [2, 3, 4, 5, 6])
+        self.assertEqual(len(self.seek_n_build.orphans), 0)
+        # our own broadcasts are recognised when peers echo them back
+        echo = ReceivedBlocks.digest(blocks[0].serialize())
+        self.assertEqual(self.seek_n_build.received.get(echo), 2)
+        self.assertTrue(self.seek_n_build.is_known(2))
+
+    def test_each_block_requested_from_one_peer(self):
+        peers = [FakePeer(), FakePeer()]
+        for peer in peers:
+            self.seek_n_build.add_peer(peer)
+        capacity = 2 * PeerState.INITIAL_CAPACITY
+        wanted = list(range(100, 100 + capacity + 8))
+        self.seek_n_build.seek_many_with_priority([(1, h) for h in wanted])
+        self.assertTrue(wait_for(lambda: len(peers[0].requested) + len(peers[1].requested) == capacity))
+        time.sleep(0.1)
+        # peers are at capacity, the rest wait for requests to be answered
+        self.assertEqual(sorted(peers[0].requested + peers[1].requested), wanted[:capacity])
+        self.assertGreater(len(peers[0].requested), 0)
+        self.assertGreater(len(peers[1].requested), 0)
+        self.assertNotIn('request_blocks', self.p2p.sent)
+
+    def test_timed_out_request_goes_to_another_peer(self):
+        self.seek_n_build.REQUEST_TIMEOUT = 0.1
+        slow, fast = FakePeer(), FakePeer()
+        self.seek_n_build.add_peer(slow)
+        self.seek_n_build.seek_with_priority((1, 100))
+        self.assertTrue(slow.received.wait(5))
+        self.seek_n_build.add_peer(fast)
+        self.assertTrue(fast.received.wait(5))
+        self.assertEqual(slow.requested, [100])
+        self.assertEqual(fast.requested, [100])
+        self.assertTrue(wait_for(lambda: self.seek_n_build.peers[slow].timeout_count == 1))
+        self.assertLess(self.seek_n_build.peers[slow].capacity, self.seek_n_build.peers[fast].capacity)
+        self.seek_n_build.add_block(FakeBlock(100, 1, 1), fast)
+        self.assertTrue(wait_for(lambda: self.seek_n_build.peers[fast].delivered_count == 1))
+        self.assertNotIn(100, self.seek_n_build.in_flight)
+
+    def test_expired_compact_block_requested(self):
+        self.seek_n_build.compact_blocks.TIMEOUT = 0.1
+        peer = FakePeer()
+        self.seek_n_build.add_peer(peer)
+        self.seek_n_build.compact_blocks.start(100, FakeCompact([10]), {}.get)
+        self.seek_n_build.watch_compact_blocks()
+        self.assertTrue(peer.received.wait(5))
+        self.assertEqual(peer.requested, [100])
+        self.assertEqual(len(self.seek_n_build.compact_blocks), 0)
+
+    def test_sent_from_p2p_loop(self):
+        self.p2p._loop = asyncio.new_event_loop()
+        p2p_thread = threading.Thread(target=self.p2p._loop.run_forever)
+        p2p_thread.start()
+        try:
+            peer = FakePeer()
+            self.seek_n_build.add_peer(peer)
+            self.seek_n_build.seek_with_priority((1, 100))
+            self.assertTrue(peer.received.wait(5))
+            self.assertEqual(peer.send_threads, {p2p_thread})
+        finally:
+            self.p2p._loop.call_soon_threadsafe(self.p2p._loop.stop)
+            p2p_thread.join()
+            self.p2p._loop.close()
+
+
+class TestReceivedBlocks(unittest.TestCase):
+
+    def test_bounded(self):
+        received = ReceivedBlocks(max_size=2)
+        digests = [ReceivedBlocks.digest(bytes([i])) for i in range(3)]
+        received.add(digests[0], 10)
+        received.add(digests[1], ReceivedBlocks.REJECTED)
+        received.add(digests[2], 12)
+        self.assertNotIn(digests[0], received)
+        self.assertIn(digests[1], received)
+        self.assertEqual(received.get(digests[1]), ReceivedBlocks.REJECTED)
+        self.assertEqual(received.get(digests[2]), 12)
+
+
+class FakeCompact(object):
+
+    def __init__(self, short_ids):
+        self.short_ids = short_ids
+
+
+class TestCompactBlocks(unittest.TestCase):
+
+    def test_complete_compact_block_is_not_kept(self):
+        compact_blocks = CompactBlocks()
+        super_txs, missing = compact_blocks.start(1, FakeCompact([10, 11]), {10: 'a', 11: 'b', 12: 'c'}.get)
+        self.assertEqual(super_txs, ['a', 'b'])
+        self.assertEqual(missing, [])
+        self.assertEqual(len(compact_blocks), 0)
+
+    def test_missing_super_txs_filled(self):
+        compact_blocks = CompactBlocks()
+        compact = FakeCompact([10, 11, 12, 13])
+        super_txs, missing = compact_blocks.start(1, compact, {11: 'b', 13: 'd'}.get)
+        self.assertEqual(missing, [0, 2])
+        self.assertEqual(compact_blocks.fill(1, ['a']), None)  # wrong number, dropped
+        compact_blocks.start(1, compact, {11: 'b', 13: 'd'}.get)
+        self.assertEqual(compact_blocks.fill(1, ['a', 'c']), (compact, ['a', 'b', 'c', 'd']))
+        self.assertEqual(compact_blocks.fill(1, ['a', 'c']), None)
+
+    def test_bounded(self):
+        compact_blocks = CompactBlocks(max_size=2)
+        for block_hash in range(3):
+            compact_blocks.start(block_hash, FakeCompact([10]), {}.get)
+        self.assertEqual(list(compact_blocks.partial), [1, 2])
+        # the evicted block is handed back at once, to be requested in full
+        self.assertEqual(compact_blocks.next_deadline(), 0)
+        self.assertEqual(compact_blocks.pop_expired(), [0])
+
+    def test_expired(self):
+        compact_blocks = CompactBlocks()
+        compact_blocks.start(1, FakeCompact([10]), {}.get, now=100)
+        compact_blocks.start(2, FakeCompact([10]), {}.get, now=102)
+        self.assertEqual(compact_blocks.next_deadline(), 100 + CompactBlocks.TIMEOUT)
+        self.assertEqual(compact_blocks.pop_expired(now=101 + CompactBlocks.TIMEOUT), [1])
+        self.assertEqual(compact_blocks.fill(1, ['a']), None)
+        self.assertEqual(compact_blocks.pop_expired(now=102 + CompactBlocks.TIMEOUT), [2])
+        self.assertEqual(compact_blocks.next_deadline(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,19 @@
 import unittest
 import time
 import sys
+import threading
 
 from binascii import unhexlify
 
 from cryptonet import Cryptonet
 from cryptonet.chain import Chain
 from cryptonet.statemaker import StateMaker
-from cryptonet.standard import Tx, SuperTx, Point
+from cryptonet.standard import Tx, SuperTx, SignedSuperTx, Point, Header, Block
+from cryptonet.datastructs import CompactBlock, MerkleLeavesToRoot
+from cryptonet.mempool import Mempool
+from cryptonet.verifier import SignatureVerifier
 from cryptonet.dapp import TxPrism
-from cryptonet.errors import ValidationError
+from cryptonet.errors import ValidationError, TemporaryValidationError
 
 import encodium
 
@@ -118,5 +122,146 @@ class TestTransactions(unittest.TestCase):
     def tearDown(self):
         pass
 
+
+class TestSignatureCache(unittest.TestCase):
+    ''' A cached signature must not vouch for the same txs claimed by a different sender. '''
+
+    class FakeBlock:
+        def __init__(self, super_txs): self.super_txs = super_txs
+        def signature_checks(self): return [super_tx.signature_check() for super_tx in self.super_txs]
+
+    def test_sender_swapped_super_tx_rejected(self):
+        verifier = SignatureVerifier(processes=1)
+        txs = [Tx(dapp=b'', value=5, fee=0, data=[b'ANDY'])]
+        super_tx = SuperTx(sender=pubkey, txs=txs).sign(secret_exponent)
+        self.assertEqual(verifier.verify_blocks([self.FakeBlock([super_tx])]), [True])
+        other = Point._from_ecdsa_point(2 * pubkey._ecdsa_point())
+        swapped = SignedSuperTx(sender=other, txs=txs, signature=super_tx.signature)
+        self.assertEqual(swapped.get_hash(), super_tx.get_hash())
+        self.assertFalse(verifier.is_verified(swapped.signature_check()[0]))
+        self.assertEqual(verifier.verify_blocks([self.FakeBlock([swapped])]), [False])
+        verifier.shutdown()
+
+    def test_off_curve_sender_fails_only_its_block(self):
+        verifier = SignatureVerifier(processes=1)
+        super_txs = [SuperTx(sender=pubkey, txs=[Tx(dapp=b'', value=value, fee=0, data=[b'ANDY'])])
+                     .sign(secret_exponent) for value in (5, 6)]
+        off_curve = SignedSuperTx(sender=Point(x=pubkey.x, y=pubkey.y + 1), txs=super_txs[0].txs,
+                                  signature=super_txs[0].signature)
+        blocks = [self.FakeBlock([super_txs[0]]), self.FakeBlock([off_curve]), self.FakeBlock([super_txs[1]])]
+        self.assertEqual(verifier.verify_blocks(blocks), [True, False, True])
+        verifier.shutdown()
+
+class TestHeaderTimestamp(unittest.TestCase):
+    ''' Only a timestamp too far in the future is a TemporaryValidationError, and only if everything else checks out
+    (blocks_handler remembers other failures as permanent).
+    '''
+
+    def mine(self, header):
+        while not header.valid_proof():
+            header.increment_nonce()
+        return header
+
+    def test_future_timestamp_is_temporary(self):
+        header = self.mine(Header(timestamp=int(time.time()) + 3600))
+        with self.assertRaises(TemporaryValidationError):
+            header.assert_internal_consistency()
+        header.timestamp = int(time.time())
+        self.mine(header).assert_internal_consistency()
+
+    def test_bad_pow_is_permanent(self):
+        header = Header(timestamp=int(time.time()) + 3600)
+        while header.valid_proof():
+            header.increment_nonce()
+        with self.assertRaises(encodium.ValidationError) as caught:
+            header.assert_internal_consistency()
+        self.assertNotIsInstance(caught.exception, TemporaryValidationError)
+
+
+class TestCompactBlock(unittest.TestCase):
+    ''' Test Block.to_compact and Block.from_compact
+    To Test:
+    * a block rebuilt from its serialized CompactBlock and a mempool is the same block
+    * a short id collision rebuilds a block with the wrong super_txs, which is rejected
+    '''
+
+    class CollidingBlock(Block):
+        SHORT_ID_BITS = 0  # every super_tx has short id 0
+
+    def setUp(self):
+        self.super_txs = [SuperTx(sender=pubkey, txs=[Tx(dapp=b'', value=value, fee=1, data=[b'ANDY'])])
+                          .sign(secret_exponent) for value in (5, 6)]
+
+    def make_block(self, block_class, super_txs):
+        header = Header(transaction_mr=MerkleLeavesToRoot(leaves=[i.get_hash() for i in super_txs]).get_hash(),
+                        uncles_mr=MerkleLeavesToRoot(leaves=[]).get_hash())
+        while not header.valid_proof():
+            header.increment_nonce()
+        return block_class(header=header, uncles=[], super_txs=super_txs)
+
+    def test_round_trip(self):
+        block = self.make_block(Block, self.super_txs)
+        compact = CompactBlock(block.to_compact().serialize())
+        self.assertEqual(compact.short_ids, [Block.short_id(super_tx) for super_tx in self.super_txs])
+        mempool = Mempool(short_id=Block.short_id_of_hash)
+        for super_tx in self.super_txs[::-1]:
+            mempool.add(super_tx)
+        rebuilt = Block.from_compact(compact, [mempool.get_by_short_id(i) for i in compact.short_ids])
+        rebuilt.assert_internal_consistency()
+        self.assertEqual(rebuilt.get_hash(), block.get_hash())
+        self.assertEqual(rebuilt.serialize(), block.serialize())
+
+    def test_collision_rejected(self):
+        block = self.make_block(self.CollidingBlock, self.super_txs[:1])
+        compact = CompactBlock(block.to_compact().serialize())
+        mempool = Mempool(short_id=self.CollidingBlock.short_id_of_hash)
+        mempool.add(self.super_txs[1])  # not in the block, but has the same short id
+        rebuilt = self.CollidingBlock.from_compact(compact, [mempool.get_by_short_id(i) for i in compact.short_ids])
+        self.assertEqual(rebuilt.get_hash(), block.get_hash())
+        with self.assertRaises(encodium.ValidationError):
+            rebuilt.assert_internal_consistency()
+
+
+
+class TestSuperTxRelay(unittest.TestCase):
+    ''' Test Cryptonet.accept_super_tx, which the super_tx handler relays with
+    To Test:
+    * a relayed super_tx lets a compact block including it be rebuilt with nothing missing
+    * a super_tx already in the mempool is not accepted (or relayed) again
+    * the future state isn't changed while chain.lock is held (e.g. mid reorganisation)
+    '''
+
+    def setUp(self):
+        self.cryptonet = Cryptonet(seeds=[], address=None, enable_p2p=False, block_class=Block)
+        self.super_tx = SuperTx(sender=pubkey, txs=[Tx(dapp=b'', value=5, fee=1, data=[b'ANDY'])]).sign(secret_exponent)
+
+    def tearDown(self):
+        self.cryptonet.seek_n_build.shutdown()
+
+    def test_relayed_super_tx_rebuilds_compact_block(self):
+        self.assertTrue(self.cryptonet.accept_super_tx(self.super_tx))
+        block = TestCompactBlock.make_block(None, Block, [self.super_tx])
+        compact = CompactBlock(block.to_compact().serialize())
+        super_txs, missing = self.cryptonet.seek_n_build.compact_blocks.start(
+            block.get_hash(), compact, self.cryptonet.pending_super_txs())
+        self.assertEqual(missing, [])
+        self.assertEqual(Block.from_compact(compact, super_txs).get_hash(), block.get_hash())
+
+    def test_duplicate_not_relayed(self):
+        self.assertTrue(self.cryptonet.accept_super_tx(self.super_tx))
+        self.assertFalse(self.cryptonet.accept_super_tx(self.super_tx))
+
+    def test_waits_for_chain_lock(self):
+        results = []
+        with self.cryptonet.chain.lock:
+            thread = threading.Thread(target=lambda: results.append(self.cryptonet.accept_super_tx(self.super_tx)))
+            thread.start()
+            thread.join(0.2)
+            self.assertNotIn(self.super_tx.get_hash(), self.cryptonet.chain.head.state_maker.mempool)
+        thread.join()
+        self.assertEqual(results, [True])
+        self.assertIn(self.super_tx.get_hash(), self.cryptonet.chain.head.state_maker.mempool)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -13,6 +13,7 @@ class TestStateDelta(unittest.TestCase):
     * absorb
     * gen_checkpoint_heights
     * after 100 checkpoints everything is as expected
+    * reads alternating between branches are correct and leave the shared index where it is
     '''
     
     def setUp(self):
@@ -71,6 +72,62 @@ class TestStateDelta(unittest.TestCase):
         self.assertEqual(cur[1], 5)
         
     
+    def test_reads_across_branches_and_prune(self):
+        cur = self.current_state
+        for i in range(1, 21):
+            cur = cur.checkpoint()
+            cur[1] = i
+        # a branch from an older checkpoint must not see later values
+        older = cur.child_at_or_before(8)
+        alt = older.checkpoint(hard_checkpoint=False)
+        self.assertEqual(alt[1], older[1])
+        self.assertTrue(older[1] < 20)
+        alt[2] = 5
+        self.assertEqual(cur[1], 20)
+        self.assertTrue(2 not in cur)
+        self.assertEqual(alt[2], 5)
+        pruned = cur.prune_to_or_beyond(8)
+        self.assertEqual(pruned[1], older[1])
+        self.assertEqual(pruned.all_keys(), set([0, 1]))
+
+    def test_alternating_reads(self):
+        main = self.current_state
+        for i in range(1, 11):
+            main = main.checkpoint()
+            main[i] = i
+        future = main.checkpoint(hard_checkpoint=False)
+        future[1] = 100
+        trial = main.child_at_or_before(5).checkpoint(hard_checkpoint=False)
+        trial[2] = 200
+        # trial wrote last so the index is its; main and future walk up their parents
+        for _ in range(3):
+            self.assertEqual((main[1], main[2], main[10]), (1, 2, 10))
+            self.assertEqual((future[1], future[2], future[10]), (100, 2, 10))
+            self.assertEqual((trial[1], trial[2], trial[10]), (1, 200, 0))
+            self.assertIs(main.index.owner, trial)
+        # a descendant of the owner takes the index over
+        child = trial.checkpoint(hard_checkpoint=False)
+        self.assertEqual(child[2], 200)
+        self.assertIs(main.index.owner, child)
+        future[3] = 300
+        self.assertIs(main.index.owner, future)
+        self.assertEqual((trial[2], trial[3], future[2], future[3]), (200, 3, 2, 300))
+
+    def test_snapshot_round_trip(self):
+        cur = self.current_state
+        for i in range(1, 11):
+            cur = cur.checkpoint()
+            cur[i] = i * 2
+        del cur[0]
+        snapshots = [d.to_snapshot() for d in cur.ancestors()[::-1]]
+        restored = StateDelta.from_snapshots(snapshots)
+        self.assertEqual(restored.height, cur.height)
+        self.assertEqual(len(restored.ancestors()), len(cur.ancestors()))
+        self.assertEqual(restored.complete_kvs(), cur.complete_kvs())
+        self.assertTrue(0 not in restored)
+        self.assertEqual(restored.parent.child, restored)
+        self.assertEqual(restored.get_hash(), cur.get_hash())
+
     def test_checkpoint_heights(self):
         expected_results = [
             (1024, [1024, 1023, 1022, 1020, 1016, 1008, 992, 960, 896, 768, 512, 0]),
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from cryptonet.constants import ROOT_DAPP
+from cryptonet.dapp import TxPrism
+from cryptonet.statemaker import StateMaker
+
+
+class FakePoint(object):
+
+    def __init__(self, x):
+        self.x = x
+        self.y = 0
+
+
+class FakeTx(object):
+
+    def __init__(self, sender, value, recipient, fee=1):
+        self.sender = sender
+        self.value = value
+        self.fee = fee
+        self.donation = 0
+        self.dapp = ROOT_DAPP
+        self.data = [recipient]
+
+
+class FakeSuperTx(object):
+
+    def __init__(self, super_tx_hash, value, sender=TxPrism.KNOWN_PUBKEY_X, recipient=b'recipient', fee=1):
+        self.super_tx_hash = super_tx_hash
+        self.sender = FakePoint(sender)
+        self.txs = [FakeTx(self.sender, value, recipient, fee)]
+
+    def get_hash(self):
+        return self.super_tx_hash
+
+    def serialize(self):
+        return bytes(100)
+
+
+class FakeBlock(object):
+
+    def __init__(self, height):
+        self.height = height
+        self.super_txs = []
+        self.roots_updated = 0
+
+    def _set_state_maker(self, state_maker):
+        self.state_maker = state_maker
+
+    def update_roots(self):
+        self.roots_updated += 1
+
+    def get_pre_candidate(self, chain):
+        return FakeBlock(self.height + 1)
+
+
+class FakeChain(object):
+    _Block = FakeBlock
+
+
+class TestFutureBlock(unittest.TestCase):
+    ''' Test the future block built by StateMaker from its mempool
+    To Test:
+    * pending super_txs are applied as one batch, roots updated once
+    * a super_tx that no longer applies is dropped without disturbing the others
+    * pending super_txs are kept across refreshes
+    * a super_tx spending funds from a pending super_tx applied after it is kept, whatever their fee rates
+    '''
+
+    def setUp(self):
+        self.state_maker = StateMaker(FakeChain())
+        self.head = FakeBlock(0)
+        self.state_maker.most_recent_block = self.head
+        self.state_maker._refresh_future_block(self.head)
+
+    def test_batch_and_invalid_super_tx(self):
+        # the future block's coinbase gives the sender 50000
+        super_txs = [FakeSuperTx(1, 20000), FakeSuperTx(2, 40000), FakeSuperTx(3, 20000)]
+        applied = self.state_maker.apply_super_txs_to_future(super_txs)
+        self.assertEqual(applied, [super_txs[0], super_txs[2]])
+        future_block = self.state_maker.future_block
+        self.assertEqual(future_block.super_txs, applied)
+        self.assertEqual(future_block.roots_updated, 2)  # on refresh, and once for the batch
+        self.assertNotIn(2, self.state_maker.mempool)
+        self.assertEqual(self.state_maker.future_super_state[ROOT_DAPP][b'recipient'], 40000)
+        # the main state is untouched
+        self.assertEqual(self.state_maker.dapps[ROOT_DAPP].state[b'recipient'], 0)
+
+        self.state_maker._refresh_future_block(self.head)
+        self.assertEqual(self.state_maker.future_block.super_txs, applied)
+        self.assertEqual(self.state_maker.future_block.roots_updated, 1)
+        self.assertEqual(self.state_maker.future_super_state[ROOT_DAPP][b'recipient'], 40000)
+
+    def test_child_with_higher_fee_rate_than_parent_is_kept(self):
+        parent = FakeSuperTx(1, 20000)
+        # spends what parent sends to b'recipient', and pays a higher fee so it is ordered first
+        child = FakeSuperTx(2, 5000, sender=int.from_bytes(b'recipient', 'big'), recipient=b'other', fee=50)
+        self.state_maker.mempool.add(parent)
+        self.state_maker.mempool.add(child)
+        self.assertEqual(self.state_maker.mempool.ordered(), [child, parent])
+        self.state_maker._refresh_future_block(self.head)
+        self.assertEqual(self.state_maker.future_block.super_txs, [parent, child])
+        self.assertIn(2, self.state_maker.mempool)
+        self.assertEqual(self.state_maker.future_super_state[ROOT_DAPP][b'other'], 5000)
+
+
+if __name__ == '__main__':
+    unittest.main()
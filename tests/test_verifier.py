@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from cryptonet.verifier import SignatureVerifier, SignatureCache, DeferredChecks, checks_deferred
+
+
+def is_even(n):
+    return n % 2 == 0
+
+
+def is_positive(n):
+    if n == 0:
+        raise ValueError('neither')
+    return n > 0
+
+
+class FakeBlock(object):
+    def __init__(self, numbers):
+        self.numbers = numbers
+
+    def signature_checks(self):
+        return [(n, is_even, (n,)) for n in self.numbers]
+
+
+class TestSignatureVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.verifier = SignatureVerifier(processes=2)
+
+    def test_verify_blocks(self):
+        blocks = [FakeBlock([2, 4, 6]), FakeBlock([8, 9]), FakeBlock([]), FakeBlock([10])]
+        self.assertEqual(self.verifier.verify_blocks(blocks), [True, False, True, True])
+        self.assertTrue(self.verifier.is_verified(4))
+        self.assertFalse(self.verifier.is_verified(9))
+        self.assertEqual(self.verifier.verify_blocks([FakeBlock([9])]), [False])
+
+    def test_raising_check_fails_only_its_block(self):
+        blocks = [FakeBlock([2]), FakeBlock([0]), FakeBlock([4])]
+        for block in blocks:
+            block.signature_checks = lambda numbers=block.numbers: [(('positive', n), is_positive, (n,))
+                                                                     for n in numbers]
+        self.assertEqual(self.verifier.verify_blocks(blocks), [True, False, True])
+
+    def test_verified_signatures_are_not_rechecked(self):
+        self.verifier.mark_verified(3)
+        self.assertEqual(self.verifier.verify_blocks([FakeBlock([2, 3])]), [True])
+
+    def test_cache_is_bounded_lru(self):
+        cache = SignatureCache(max_size=2)
+        cache.add((1, b'a'))
+        cache.add((2, b'b'))
+        self.assertTrue((1, b'a') in cache)
+        cache.add((3, b'c'))
+        self.assertFalse((2, b'b') in cache)
+        self.assertFalse((1, b'other signature') in cache)
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'misses': 2})
+
+    def test_deferred_checks(self):
+        self.assertFalse(checks_deferred())
+        with DeferredChecks():
+            self.assertTrue(checks_deferred())
+        self.assertFalse(checks_deferred())
+
+    def tearDown(self):
+        self.verifier.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
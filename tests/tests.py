@@ -34,6 +34,65 @@ class TestCryptonet(unittest.TestCase):
         self.assertEqual(mt.root, 89752586187535061124859689857005670910448617032952735280732624523812978565650)
 
 
+class TestMerklePatriciaTree(unittest.TestCase):
+
+    def test_root_independent_of_history(self):
+        tree = MerklePatriciaTree()
+        self.assertEqual(tree.get_hash(), 0)
+        for i in range(50):
+            tree = tree.set(i, i * i)
+        other = MerklePatriciaTree()
+        for i in reversed(range(60)):
+            other = other.set(i, 7)
+        for i in range(50, 60):
+            other = other.delete(i)
+        for i in range(50):
+            other = other.set(i, i * i)
+        self.assertEqual(tree.get_hash(), other.get_hash())
+
+    def test_immutable_and_delete_to_empty(self):
+        tree = MerklePatriciaTree().set(1, 1).set(2, 2)
+        root = tree.get_hash()
+        changed = tree.set(2, 3)
+        self.assertEqual(tree.get_hash(), root)
+        self.assertNotEqual(changed.get_hash(), root)
+        self.assertEqual(changed.set(2, 2).get_hash(), root)
+        self.assertEqual(tree.delete(3).get_hash(), root)
+        self.assertEqual(tree.delete(1).delete(2).get_hash(), 0)
+
+
+class TestHeaderMining(unittest.TestCase):
+
+    def make_header(self):
+        from cryptonet.standard import Header
+        return Header(version=1, nonce=0, height=1, timestamp=1, target=2 ** 245, sigma_diff=0, state_mr=0,
+                      transaction_mr=0, uncles_mr=0, previous_blocks=[5])
+
+    def test_search_nonces_matches_increment_nonce(self):
+        fast, slow = self.make_header(), self.make_header()
+        solution = fast.search_nonces(100000)
+        while not slow.valid_proof():
+            slow.increment_nonce()
+        self.assertEqual(solution, slow.nonce)
+        self.assertEqual(fast.nonce, slow.nonce)
+        self.assertEqual(fast.get_hash(), slow.get_hash())
+
+    def test_search_nonces_advances_on_failure(self):
+        header = self.make_header()
+        header.target = 1
+        self.assertEqual(header.search_nonces(10), None)
+        self.assertEqual(header.nonce, 10)
+
+    def test_hash_memoized_until_header_changes(self):
+        from cryptonet.utilities import global_hash
+        header = self.make_header()
+        first_hash = header.get_hash()
+        self.assertEqual(header.get_hash(), first_hash)
+        header.increment_nonce()
+        self.assertNotEqual(header.get_hash(), first_hash)
+        self.assertEqual(header.get_hash(), global_hash(header.to_bytes()))
+        header.search_nonces(100000)
+        self.assertEqual(header.get_hash(), global_hash(header.to_bytes()))
 
 
 if __name__ == '__main__':